@@ -30,6 +30,7 @@ region = tweets_processing_config['region']
 aggregation_config = Variable.get("aggregation_variables", deserialize_json=True)
 agg_storage = aggregation_config['storage']
 agg_incremental = aggregation_config['incremental']
+agg_format = aggregation_config.get('format', 'csv')
 
 dag = DAG(
     'COVID19',
@@ -59,7 +60,7 @@ tweet_cleaning = BashOperator(
 aggregation = BashOperator(
     task_id='Day_Level_Aggregation',
     bash_command=f'python3 /usr/local/airflow/projects/day_level_aggregation.py -c {config_path } \
-                 -s {agg_storage} -i {agg_incremental}',
+                 -s {agg_storage} -i {agg_incremental} -f {agg_format}',
     dag=dag
 )
 
@@ -73,7 +74,8 @@ covid_case_deaths = BashOperator(
 # Combining_data from all sources
 combining = BashOperator(
     task_id='Combining_all_sources',
-    bash_command=f'python3 /usr/local/airflow/projects/day_level_aggregation.py -c {config_path} -s {agg_storage}',
+    bash_command=f'python3 /usr/local/airflow/projects/combining_sources.py -c {config_path} \
+                 -s {agg_storage} -i {agg_incremental}',
     dag=dag
 )
 
@@ -6,9 +6,14 @@
 import pickle
 import yaml
 import pandas as pd
-from azure.storage.blob import BlobClient, BlobServiceClient
+from azure.storage.blob import ContainerClient
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+import requests
 import glob
+import hashlib
+import io
+import tempfile
 import os
 import sys
 from pytz import timezone
@@ -20,10 +25,170 @@ CONNECTION_STR = ''
 CONTAINER = ''
 TEMP_PATH = ''
 TIMEZONE = 'US/Eastern'
+# Blobs bigger than SPOOL_MAX_SIZE bytes are spooled to a temporary file instead of memory while reading.
+SPOOL_MAX_SIZE = 256 * 1024 * 1024
+# Number of parallel ranged requests used to download large blobs.
+DOWNLOAD_CONCURRENCY = 8
+PARQUET_COMPRESSION = 'snappy'
+# Storage backend of the current process. It's created once by "get_storage".
+STORAGE = None
+
+
+class LocalStorage:
+    """
+    Files stored on local disk.
+    """
+    def list_files(self, filepath, format='csv'):
+        return list(map(os.path.basename, glob.glob(f"{filepath}/*.{format}")))
+
+    def list_files_recursive(self, filepath, format='csv'):
+        return [os.path.relpath(file, filepath).replace(os.sep, '/')
+                for file in glob.glob(f"{filepath}/**/*.{format}", recursive=True)]
+
+    def list_file_properties(self, filepath, format='csv', recursive=False):
+        properties = {}
+        pattern = f"{filepath}/**/*.{format}" if recursive else f"{filepath}/*.{format}"
+        for file in glob.glob(pattern, recursive=recursive):
+            stat = os.stat(file)
+            properties[os.path.relpath(file, filepath).replace(os.sep, '/')] = {'size': stat.st_size,
+                                                                                'version': str(stat.st_mtime_ns)}
+        return properties
+
+    def exists(self, file):
+        return os.path.exists(file)
+
+    def remove_file(self, file):
+        if os.path.exists(file):
+            os.remove(file)
+
+    def rewrite_file(self, chunks, file, sep=','):
+        temp_file = f"{file}.{os.getpid()}.tmp"
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(temp_file, index=False, sep=sep, mode='w' if header else 'a', header=header)
+            header = False
+        if not header:
+            os.replace(temp_file, file)
+
+    def get_modified_time(self, file):
+        return parse(str(time.ctime(os.path.getmtime(file)))).replace(
+            tzinfo=timezone('US/Eastern'))
+
+    def get_checksum(self, file):
+        md5 = hashlib.md5()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+
+class AzureStorage:
+    """
+    Blobs stored in an azure container. A single container client with a pooled HTTP session is shared by all
+    the blob clients, so connection string is parsed once and connections are reused across calls. Any endpoint
+    given in the connection string (e.g. Azurite emulator) works the same way.
+    """
+    def __init__(self, connection_string, container, pool_size=16):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.container_client = ContainerClient.from_connection_string(
+            conn_str=connection_string, container_name=container,
+            transport=RequestsTransport(session=session, session_owner=False))
+
+    def get_blob_client(self, blob_name):
+        return self.container_client.get_blob_client(blob_name)
+
+    def download(self, blob_name):
+        """
+        Downloading a blob into an in-memory (spooled) buffer. Large blobs are downloaded with parallel ranged
+        requests.
+
+        :param blob_name: blob name
+        :return: file like object positioned at the start of the blob
+        """
+        buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.get_blob_client(blob_name).download_blob(max_concurrency=DOWNLOAD_CONCURRENCY).readinto(buffer)
+        buffer.seek(0)
+        return buffer
+
+    def list_files(self, filepath, format='csv'):
+        blob_list = self.container_client.list_blobs(f"{filepath}/")
+        return [os.path.basename(blob.name) for blob in blob_list]
+
+    def list_files_recursive(self, filepath, format='csv'):
+        blob_list = self.container_client.list_blobs(f"{filepath}/")
+        return [blob.name[len(filepath) + 1:] for blob in blob_list if blob.name.endswith(f".{format}")]
+
+    def list_file_properties(self, filepath, format='csv', recursive=False):
+        properties = {}
+        for blob in self.container_client.list_blobs(f"{filepath}/"):
+            name = blob.name[len(filepath) + 1:]
+            if blob.name.endswith(f".{format}") and (recursive or '/' not in name):
+                properties[name] = {'size': blob.size, 'version': blob.etag.strip('"')}
+        return properties
+
+    def exists(self, file):
+        try:
+            self.get_blob_client(file).get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        return True
+
+    def remove_file(self, file):
+        try:
+            self.get_blob_client(file).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+    def rewrite_file(self, chunks, file, sep=','):
+        temp_blob = self.get_blob_client(f"{file}.{os.getpid()}.tmp")
+        header = True
+        for chunk in chunks:
+            if header:
+                temp_blob.create_append_blob()
+            temp_blob.upload_blob(chunk.to_csv(sep=sep, index=False, header=header), overwrite=False,
+                                  blob_type='AppendBlob')
+            header = False
+        if header:
+            return
+        # Server side copy i.e. the blob is replaced by the temporary blob without downloading it.
+        blob = self.get_blob_client(file)
+        blob.start_copy_from_url(temp_blob.url)
+        while blob.get_blob_properties().copy.status == 'pending':
+            time.sleep(1)
+        temp_blob.delete_blob()
+
+    def get_modified_time(self, file):
+        return self.get_blob_client(file).get_blob_properties()['last_modified'].astimezone(timezone(TIMEZONE))
+
+    def get_checksum(self, file):
+        blob = self.get_blob_client(file)
+        content_md5 = blob.get_blob_properties()['content_settings']['content_md5']
+        if content_md5:
+            return bytes(content_md5).hex()
+        # No stored hash (e.g. append blobs), so the content is hashed while it's streamed.
+        md5 = hashlib.md5()
+        for chunk in blob.download_blob().chunks():
+            md5.update(chunk)
+        return md5.hexdigest()
+
+
+def get_storage():
+    global STORAGE
+    # HTTP connections can't be shared with forked processes, so every process creates its own backend.
+    if STORAGE is None or STORAGE.pid != os.getpid():
+        if DATABASE == 'azure':
+            STORAGE = AzureStorage(CONNECTION_STR, CONTAINER)
+        else:
+            STORAGE = LocalStorage()
+        STORAGE.pid = os.getpid()
+    return STORAGE
 
 
 def load_config(config_path):
-    global DATABASE, CONNECTION_STR, CONTAINER, TEMP_PATH
+    global DATABASE, CONNECTION_STR, CONTAINER, TEMP_PATH, STORAGE
 
     yaml_file = open(config_path)
     config = yaml.load(yaml_file, Loader=yaml.FullLoader)
@@ -42,7 +207,14 @@ def load_config(config_path):
     os.environ['DAILY_DATA_PATH'] = PATH + '/aggregate'
     TEMP_PATH = os.environ['TEMP_PATH'] = './intermediary'
     os.environ['GOOGLE_API_KEY'] = config['google_api_key']
+    os.environ['GEOCODE_URL'] = config.get('geocode_url', 'https://maps.googleapis.com/maps/api/geocode/json')
+    os.environ['GEOCODE_RATE_LIMIT'] = str(config.get('geocode_rate_limit', 10))
+    os.environ['GEOCODE_WORKERS'] = str(config.get('geocode_workers', 4))
+    os.environ['GEOCODE_MODE'] = config.get('geocode_mode', 'google')
+    os.environ['GEOCODE_MAX_DISTANCE'] = str(config.get('geocode_max_distance_km', 25))
+    os.environ['COVID_API_URL'] = config.get('covid_api_url', 'https://api.covidtracking.com/v1/states/daily.csv')
     os.environ['TIMEZONE'] = TIMEZONE
+    STORAGE = None
 
 
     if DATABASE == 'local':
@@ -55,49 +227,62 @@ def load_config(config_path):
 def store_file(data, filepath, filename, sep=',', mode='w', header=True):
     file_format = filename.split('.')[-1]
     if DATABASE == 'local':
-        if file_format == 'csv':
+        if file_format == 'csv' and mode == 'w':
+            # Writing to a temporary file first so a crash never leaves a half written file.
+            temp_file = f"{filepath}/{filename}.{os.getpid()}.tmp"
+            data.to_csv(temp_file, index=False, sep=sep, header=header)
+            os.replace(temp_file, f"{filepath}/{filename}")
+        elif file_format == 'csv':
             data.to_csv(f'{filepath}/{filename}', index=False, sep=sep, mode=mode, header=header)
         elif file_format == 'pkl':
-            with open(f"{filepath}/{filename}", 'wb') as f:
+            # Writing to a temporary file first so a crash never leaves a half written pickle.
+            temp_file = f"{filepath}/{filename}.{os.getpid()}.tmp"
+            with open(temp_file, 'wb') as f:
                 pickle.dump(data, f)
+            os.replace(temp_file, f"{filepath}/{filename}")
         elif file_format == 'txt':
             with open(f"{filepath}/{filename}", 'w') as f:
                 f.write(data)
+        elif file_format == 'parquet':
+            os.makedirs(os.path.dirname(f"{filepath}/{filename}"), exist_ok=True)
+            data.to_parquet(f"{filepath}/{filename}", index=False, compression=PARQUET_COMPRESSION)
     elif DATABASE == 'azure':
         if file_format == 'csv':
             output = data.to_csv(sep=sep, index=False, mode=mode, header=header)
-            blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                     container_name=CONTAINER,
-                                                     blob_name=f"{filepath}/{filename}")
+            blob = get_storage().get_blob_client(f"{filepath}/{filename}")
             if header:
                 blob.create_append_blob()
                 blob.upload_blob(output, overwrite=True, blob_type='AppendBlob')
             else:
                 blob.upload_blob(output, overwrite=False, blob_type='AppendBlob')
         elif file_format == 'pkl':
-            blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                     container_name=CONTAINER,
-                                                     blob_name=f"{filepath}/{filename}")
-            with open(f"{TEMP_PATH}/PickleFile.pkl", 'wb') as f:
-                pickle.dump(data, f)
-            with open(f"{TEMP_PATH}/PickleFile.pkl", 'rb') as data:
-                blob.upload_blob(data, overwrite=True)
+            blob = get_storage().get_blob_client(f"{filepath}/{filename}")
+            blob.upload_blob(pickle.dumps(data), overwrite=True)
         elif file_format == 'txt':
-            blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                     container_name=CONTAINER,
-                                                     blob_name=f"{filepath}/{filename}")
-            with open(f"{TEMP_PATH}/TextFile.txt", 'w') as f:
-                f.write(data)
-            with open(f"{TEMP_PATH}/TextFole.txt", 'r') as data:
-                blob.upload_blob(data, overwrite=True)
+            blob = get_storage().get_blob_client(f"{filepath}/{filename}")
+            blob.upload_blob(data, overwrite=True)
+        elif file_format == 'parquet':
+            output = io.BytesIO()
+            data.to_parquet(output, index=False, compression=PARQUET_COMPRESSION)
+            blob = get_storage().get_blob_client(f"{filepath}/{filename}")
+            blob.upload_blob(output.getvalue(), overwrite=True)
+
 
-def retrieve_file(filepath, filename, sep=',', usecols=None, skiprows=None):
+def retrieve_file(filepath, filename, sep=',', usecols=None, skiprows=None, chunksize=None, dtype=None,
+                  na_filter=True):
+    """
+    :param usecols: columns to be read (csv, xls and parquet files)
+    :param chunksize: if given, csv files are returned as an iterator of dataframes with "chunksize" rows each.
+    :param dtype: data type of the columns of csv files, so they aren't inferred while parsing.
+    :param na_filter: if False, empty values of csv files are read as empty strings instead of NaN.
+    """
     file_format = filename.split('.')[-1]
     data = False
     try:
         if DATABASE == 'local':
             if file_format == 'csv':
-                data = pd.read_csv(f'{filepath}/{filename}', sep=sep, usecols=usecols, skiprows=skiprows)
+                data = pd.read_csv(f'{filepath}/{filename}', sep=sep, usecols=usecols, skiprows=skiprows,
+                                   chunksize=chunksize, dtype=dtype, na_filter=na_filter)
             elif file_format == 'xls':
                 data = pd.read_excel(f'{filepath}/{filename}', sep=sep, usecols=usecols, skiprows=skiprows)
             elif file_format == 'pkl':
@@ -105,82 +290,71 @@ def retrieve_file(filepath, filename, sep=',', usecols=None, skiprows=None):
                     data = pickle.load(f)
             elif file_format == 'txt':
                 data = open(f"{filepath}/{filename}", 'r')
+            elif file_format == 'parquet':
+                data = pd.read_parquet(f"{filepath}/{filename}", columns=usecols)
         elif DATABASE == 'azure':
+            # Blobs are read straight from the downloaded buffer i.e. no intermediary files.
+            buffer = get_storage().download(f"{filepath}/{filename}")
             if file_format == 'csv':
-                blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                         container_name=CONTAINER,
-                                                         blob_name=f"{filepath}/{filename}")
-                with open(TEMP_PATH + "/CSVFile.csv", "wb") as my_blob:
-                    blob_data = blob.download_blob()
-                    blob_data.readinto(my_blob)
-
-                data = pd.read_csv(TEMP_PATH + "/CSVFile.csv", sep=sep, usecols=usecols, skiprows=skiprows)
+                data = pd.read_csv(buffer, sep=sep, usecols=usecols, skiprows=skiprows, chunksize=chunksize,
+                                   dtype=dtype, na_filter=na_filter)
             elif file_format == 'xls':
-                blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                         container_name=CONTAINER,
-                                                         blob_name=f"{filepath}/{filename}")
-                with open(TEMP_PATH + "/ExcelFile.xls", "wb") as my_blob:
-                    blob_data = blob.download_blob()
-                    blob_data.readinto(my_blob)
-
-                data = pd.read_excel(TEMP_PATH + "/ExcelFile.xls", sep=sep, usecols=usecols, skiprows=skiprows)
+                data = pd.read_excel(buffer, sep=sep, usecols=usecols, skiprows=skiprows)
             elif file_format == 'pkl':
-                blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                         container_name=CONTAINER,
-                                                         blob_name=f"{filepath}/{filename}")
-                with open(f"{TEMP_PATH}/PickleFile.pkl", 'wb') as my_blob:
-                    blob_data = blob.download_blob()
-                    blob_data.readinto(my_blob)
-
-                with open(f"{TEMP_PATH}/PickleFile.pkl", 'rb') as f:
-                    data = pickle.load(f)
+                data = pickle.load(buffer)
             elif file_format == 'txt':
-                blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                         container_name=CONTAINER,
-                                                         blob_name=f"{filepath}/{filename}")
-                with open(f"{TEMP_PATH}/TextFile.txt", 'wb') as my_blob:
-                    blob_data = blob.download_blob()
-                    blob_data.readinto(my_blob)
-
-                data = open(f"{TEMP_PATH}/TextFile.txt", 'r')
+                data = io.StringIO(buffer.read().decode('utf-8'))
+            elif file_format == 'parquet':
+                data = pd.read_parquet(io.BytesIO(buffer.read()), columns=usecols)
         return data
     except Exception as e:
         print(e)
         sys.exit(0)
 
 
-def list_files(filepath, format='csv'):
-    if DATABASE == 'local':
-        filenames = list(map(os.path.basename, glob.glob(f"{filepath}/*.{format}")))
-    elif DATABASE == 'azure':
-        blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STR)
-        container_client = blob_service_client.get_container_client(CONTAINER)
-        blob_list = container_client.list_blobs(f"{filepath}/")
-        filenames = [os.path.basename(blob.name) for blob in blob_list]
+def list_files(filepath, format='csv', recursive=False):
+    """
+    :param recursive: if True, files of all sub folders are listed with their path relative to "filepath"
+    e.g. "week=5/file.parquet"
+    """
+    if recursive:
+        return get_storage().list_files_recursive(filepath, format)
+    return get_storage().list_files(filepath, format)
+
 
-    return filenames
+def list_file_properties(filepath, format='csv', recursive=False):
+    """
+    Size and version (modified time or etag) of each file in one listing call, so unchanged files can be
+    detected without reading them.
+
+    :param recursive: if True, files of all sub folders are listed with their path relative to "filepath"
+    :return: dictionary of file name -> {'size': ..., 'version': ...}
+    """
+    return get_storage().list_file_properties(filepath, format, recursive)
 
 
 def exists(file):
-    if DATABASE == "azure":
-        blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                 container_name=CONTAINER,
-                                                 blob_name=file)
-        try:
-            blob.get_blob_properties()
-        except ResourceNotFoundError:
-            return False
-        return True
-    elif DATABASE == "local":
-        return os.path.exists(file)
+    return get_storage().exists(file)
+
+
+def remove_file(file):
+    get_storage().remove_file(file)
+
+
+def rewrite_file(chunks, filepath, filename, sep=','):
+    """
+    Writing a csv file chunk by chunk into a temporary file which replaces the file once all the chunks are
+    written, so large files are rewritten without loading them into memory and an interrupted rewrite never
+    leaves a half written file. Nothing is replaced if there is no chunk.
+
+    :param chunks: iterable of data frames, e.g. filtered chunks of the same file read with "chunksize"
+    """
+    get_storage().rewrite_file(chunks, f"{filepath}/{filename}", sep)
 
 
 def get_modified_time(file):
-    if DATABASE == 'azure':
-        blob = BlobClient.from_connection_string(conn_str=CONNECTION_STR,
-                                                 container_name=CONTAINER,
-                                                 blob_name=file)
-        return blob.get_blob_properties()['last_modified'].astimezone(timezone(TIMEZONE))
-    elif DATABASE == 'local':
-        return parse(str(time.ctime(os.path.getmtime(file)))).replace(
-            tzinfo=timezone('US/Eastern'))
+    return get_storage().get_modified_time(file)
+
+
+def get_checksum(file):
+    return get_storage().get_checksum(file)
@@ -0,0 +1,342 @@
+# Description: Throughput (rows/sec) and peak memory of every stage of the pipeline on synthetic tweets. Results are
+# compared against a stored baseline so that regressions are caught before a DAG run overshoots its schedule.
+# Everything runs offline against the local storage backend; reverse geocoding is served by a local stub server.
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import Utilities
+from Utilities import load_config, store_file
+
+# Global Variables
+REQ_COL = ['user_id', 'screen_name', 'status_id', 'created_at',
+           'text', 'source', 'is_retweet', 'retweet_count', 'hashtags', 'status_url',
+           'urls_t.co', 'lang', 'retweet_created_at', 'verified', 'retweet_location', 'location', 'bbox_coords']
+EMOTION_WORDS = ['happy', 'fear', 'hope', 'death', 'love', 'sick', 'trust', 'angry', 'virus', 'pandemic', 'safe',
+                 'crisis', 'grateful', 'panic', 'doctor', 'nurse', 'hospital', 'lockdown', 'worried', 'good', 'bad',
+                 'terrible', 'thank', 'help', 'kill', 'cure', 'vaccine', 'disaster', 'joy', 'sad']
+NEUTRAL_WORDS = ['the', 'a', 'to', 'of', 'and', 'in', 'is', 'for', 'we', 'you', 'it', 'this', 'people', 'today',
+                 'home', 'work', 'cases', 'new', 'state', 'now', 'more', 'week', 'mask', 'test', 'testing', 'all',
+                 '2020', '19', 'news', 'update']
+HASHTAGS = ['#covid19', '#coronavirus', '#StayHome', '#SocialDistancing', '#COVID', '#lockdown', '#WearAMask']
+EMOJIS = ['<U+0001F637>', '<U+0001F64F>', '<U+0001F622>', '<U+2764><U+FE0F>']
+LOCATIONS = ['Austin, TX', 'Houston, Texas', 'Los Angeles, CA', 'San Francisco, California', 'New York, NY',
+             'Brooklyn, NY', 'Texas, USA', 'California, USA', 'New York, USA', 'Dallas', 'Chicago, IL',
+             'Seattle, WA', 'Miami, FL', 'USA', 'United States', 'NYC', 'Earth', 'she/her', 'London, England',
+             'Toronto, Ontario', 'somewhere over the rainbow', 'San Juan, Puerto Rico']
+# Places (city, county, state, longitude, latitude) used for bounding boxes and the stub geocoder.
+PLACES = [('Austin', 'Travis County', 'TX', -97.74, 30.27), ('Houston', 'Harris County', 'TX', -95.37, 29.76),
+          ('Dallas', 'Dallas County', 'TX', -96.80, 32.78),
+          ('Los Angeles', 'Los Angeles County', 'CA', -118.24, 34.05),
+          ('San Francisco', 'San Francisco County', 'CA', -122.42, 37.77),
+          ('New York', 'New York County', 'NY', -74.01, 40.71), ('Buffalo', 'Erie County', 'NY', -78.88, 42.89),
+          ('Chicago', 'Cook County', 'IL', -87.63, 41.88), ('Seattle', 'King County', 'WA', -122.33, 47.61),
+          ('Miami', 'Miami-Dade County', 'FL', -80.19, 25.76)]
+STAGES = ['data_preprocessing', 'get_emotions', 'retweetLoc', 'coord', 'geo_tagging', 'agg_at_daily_level']
+
+
+def generate_tweets(n, seed=0, bbox_ratio=0.03, retweet_location_ratio=0.3, location_ratio=0.7,
+                    duplicate_ratio=0.02, english_ratio=0.9, n_places=200, year=None):
+    """
+    Deterministic synthetic tweets with the same columns and formats as the CSVs written by "tweets_scraper.R".
+
+    :param n: number of tweets
+    :param seed: random seed
+    :param bbox_ratio: share of tweets with bounding box coordinates
+    :param retweet_location_ratio: share of tweets with retweet location
+    :param location_ratio: share of tweets with user's profile location
+    :param duplicate_ratio: share of tweets having a duplicate tweet id
+    :param english_ratio: share of english tweets
+    :param n_places: number of distinct bounding boxes
+    :param year: year of the tweets (current year by default)
+    :return: dataframe with rtweet columns
+    """
+    rng = np.random.RandomState(seed)
+    year = year or datetime.date.today().year
+
+    # Text i.e. a mix of emotion words, neutral words, hashtags, mentions, urls, emojis and new lines
+    vocabulary = np.array(EMOTION_WORDS + NEUTRAL_WORDS * 3 + HASHTAGS + EMOJIS +
+                          ['@user{}'.format(i) for i in range(10)] +
+                          ['https://t.co/abc{}'.format(i) for i in range(5)] +
+                          ['\n', '&amp;', 'COVID-19!!', "don't"])
+    lengths = rng.randint(5, 30, n)
+    tokens = vocabulary[rng.randint(0, len(vocabulary), lengths.sum())]
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    text = [' '.join(tokens[bounds[i]:bounds[i + 1]]) for i in range(n)]
+
+    status_id = rng.randint(10 ** 8, 10 ** 9, n).astype('int64') * 10 ** 9 + np.arange(n)
+    duplicates = rng.rand(n) < duplicate_ratio
+    status_id[duplicates] = status_id[rng.randint(0, n, n)][duplicates]
+    start = pd.Timestamp('{}-01-01'.format(year))
+    created_at = start + pd.to_timedelta(rng.randint(0, 364 * 86400, n), unit='s')
+
+    # Bounding boxes of "n_places" places around the cities in PLACES
+    place_city = rng.randint(0, len(PLACES), n_places)
+    place_center = np.array([PLACES[i][3:] for i in place_city]) + rng.uniform(-0.2, 0.2, (n_places, 2))
+    place_size = rng.uniform(0.01, 0.2, n_places)
+    bbox = ['{0} {1} {1} {0} {2} {2} {3} {3}'.format(round(lng - size, 6), round(lng + size, 6),
+                                                     round(lat - size, 6), round(lat + size, 6))
+            for (lng, lat), size in zip(place_center, place_size)]
+    bbox_coords = np.array(bbox + ['NA NA NA NA NA NA NA NA'])[
+        np.where(rng.rand(n) < bbox_ratio, rng.randint(0, n_places, n), n_places)]
+
+    def optional(values, ratio):
+        values = np.array(values, dtype=object)[rng.randint(0, len(values), n)]
+        values[rng.rand(n) >= ratio] = np.nan
+        return values
+
+    is_retweet = rng.rand(n) < 0.4
+    return pd.DataFrame({
+        'user_id': ['x{}'.format(i) for i in rng.randint(10 ** 6, 10 ** 9, n)],
+        'status_id': ['x{}'.format(i) for i in status_id],
+        'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'screen_name': ['user{}'.format(i) for i in rng.randint(0, 10 ** 6, n)],
+        'text': text,
+        'source': rng.choice(['Twitter for iPhone', 'Twitter for Android', 'Twitter Web App'], n),
+        'is_retweet': np.where(is_retweet, 'TRUE', 'FALSE'),
+        'retweet_count': rng.poisson(3, n),
+        'hashtags': optional(['covid19', 'coronavirus StayHome', 'COVID'], 0.5),
+        'status_url': ['https://twitter.com/i/web/status/{}'.format(i) for i in status_id],
+        'urls_t.co': optional(['https://t.co/abc'], 0.3),
+        'lang': np.where(rng.rand(n) < english_ratio, 'en', rng.choice(['es', 'fr', 'und'], n)),
+        'retweet_created_at': pd.Series(created_at.strftime('%Y-%m-%d %H:%M:%S')).where(is_retweet).values,
+        'verified': np.where(rng.rand(n) < 0.05, 'TRUE', 'FALSE'),
+        'retweet_location': optional(LOCATIONS, retweet_location_ratio),
+        'location': optional(LOCATIONS, location_ratio),
+        'bbox_coords': bbox_coords,
+    })
+
+
+class StubGeocoder(BaseHTTPRequestHandler):
+    """
+    Offline reverse geocoding endpoint returning Google API responses for the nearest place of PLACES.
+    """
+    def do_GET(self):
+        lat, lng = map(float, parse_qs(urlparse(self.path).query)['latlng'][0].split(','))
+        city, county, state, _, _ = min(PLACES, key=lambda p: (p[3] - lng) ** 2 + (p[4] - lat) ** 2)
+        body = json.dumps({'status': 'OK', 'results': [{'address_components': [
+            {'long_name': city, 'short_name': city, 'types': ['locality', 'political']},
+            {'long_name': county, 'short_name': county, 'types': ['administrative_area_level_2', 'political']},
+            {'long_name': state, 'short_name': state, 'types': ['administrative_area_level_1', 'political']},
+            {'long_name': 'United States', 'short_name': 'US', 'types': ['country', 'political']}]}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_geocoder():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGeocoder)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(results, stage, rows, func, *args):
+    """
+    Running "func" and recording its rows/sec and peak memory (allocations traced by tracemalloc during the
+    stage). Timings include the tracemalloc overhead, same as the baseline.
+
+    :return: result of "func"
+    """
+    tracemalloc.stop()
+    tracemalloc.start()
+    started_at = time.time()
+    output = func(*args)
+    elapsed = max(time.time() - started_at, 1e-6)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results[stage] = {'rows': int(rows), 'seconds': round(elapsed, 4), 'rows_per_sec': round(rows / elapsed, 2),
+                      'peak_mb': round(peak / 2 ** 20, 2)}
+    print('{:<20} {:>10} rows {:>10.2f} sec {:>12.0f} rows/sec {:>10.2f} MB'.format(
+        stage, rows, elapsed, rows / elapsed, peak / 2 ** 20))
+    return output
+
+
+def reset_location_caches(locations_info):
+    # Every location stage starts with empty caches, so all of them measure the same (cold) work.
+    locations_info.LOCATION_CACHE = None
+    locations_info.GEOCODE_CACHE = None
+    for filename in ['location_caching.pkl', 'address_caching.csv']:
+        if os.path.exists(f"{locations_info.PROCESSED_PATH}/{filename}"):
+            os.remove(f"{locations_info.PROCESSED_PATH}/{filename}")
+
+
+def run_benchmark(workspace, rows, files=1, seed=0):
+    """
+    :param workspace: local folder for raw, processed, weekly and aggregated files
+    :param rows: number of synthetic tweets per raw file
+    :param files: number of raw files
+    :param seed: random seed of the synthetic tweets
+    :return: dictionary of stage -> rows, seconds, rows/sec and peak memory (MB)
+    """
+    # Imported here as these modules read the paths from environment variables while importing.
+    import tweets_processing
+    import emotions_info
+    import locations_info
+    import day_level_aggregation
+    tweets_processing.update_global_variables()
+    day_level_aggregation.update_global_variables()
+
+    raw_path = f"{workspace}/raw/benchmark"
+    os.makedirs(raw_path, exist_ok=True)
+    for i in range(files):
+        store_file(generate_tweets(rows, seed=seed + i), raw_path, 'benchmark_{}.csv'.format(i))
+
+    # One time costs (lexicon artifact and gazetteer) aren't measured.
+    emotions = emotions_info.Emotions()
+    locations_info.get_gazetteer()
+
+    results = {}
+
+    def preprocessing():
+        return pd.concat([tweets_processing.data_preprocessing(raw_path, 'benchmark_{}.csv'.format(i), REQ_COL,
+                                                                emotions) for i in range(files)],
+                         axis=0, ignore_index=True)
+    data = measure(results, 'data_preprocessing', rows * files, preprocessing)
+    measure(results, 'get_emotions', len(data), emotions.get_emotions, data['cleaned_text'])
+
+    retweet_df = data.assign(Flag_Loc=np.where(data['retweet_location'].isnull(), 'NA', 'ReTweetLoc'))
+    reset_location_caches(locations_info)
+    measure(results, 'retweetLoc', (retweet_df['Flag_Loc'] == 'ReTweetLoc').sum(), locations_info.retweetLoc,
+            retweet_df, 'ReTweetLoc', 'retweet_location')
+
+    geo_df = data.assign(Flag_Loc=np.where(data['bbox_coords'] == 'NA NA NA NA NA NA NA NA', 'NA', 'GeoCoord'))
+    reset_location_caches(locations_info)
+    measure(results, 'coord', (geo_df['Flag_Loc'] == 'GeoCoord').sum(), locations_info.coord,
+            geo_df, 'GeoCoord', 'bbox_coords')
+
+    reset_location_caches(locations_info)
+    data = measure(results, 'geo_tagging', len(data), locations_info.geo_tagging, data, 'usa')
+
+    # Weekly files of the processed tweets
+    for w, weekly_df in data.groupby('week'):
+        store_file(weekly_df, tweets_processing.WEEKLY_DATA_PATH, 'Week{}_benchmark.csv'.format(w), sep='\t')
+    measure(results, 'agg_at_daily_level', len(data), day_level_aggregation.agg_at_daily_level, 'single', False)
+
+    emotions.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: results of the current run
+    :param baseline: results of the baseline run
+    :param tolerance: allowed slow down (or memory increase) ratio e.g. 0.2 i.e. 20%
+    :return: list of regressed stages
+    """
+    regressions = []
+    print('\n{:<20} {:>14} {:>14}'.format('Stage', 'Speed', 'Peak Memory'))
+    for stage in STAGES:
+        if stage not in results or stage not in baseline:
+            continue
+        speed = results[stage]['rows_per_sec'] / max(baseline[stage]['rows_per_sec'], 1e-6)
+        memory = results[stage]['peak_mb'] / max(baseline[stage]['peak_mb'], 1e-6)
+        regressed = (speed < 1 - tolerance) or (memory > 1 + tolerance)
+        print('{:<20} {:>13.2f}x {:>13.2f}x {}'.format(stage, speed, memory, 'REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+
+def main(flat_files, baseline_path, rows, files=1, seed=0, tolerance=0.2, update_baseline=False, workspace=None):
+    """
+    :param flat_files: folder with the flat files (NRC lexicon, uscities.csv, PopulationEstimates.xls)
+    :param baseline_path: json file with the baseline results
+    :param rows: number of synthetic tweets per raw file
+    :param files: number of raw files
+    :param seed: random seed of the synthetic tweets
+    :param tolerance: allowed slow down (or memory increase) ratio before a stage is reported as a regression
+    :param update_baseline: store the results of this run as the new baseline
+    :param workspace: local folder for the benchmark files; a temporary folder (removed at the end) by default
+    :return: list of regressed stages
+    """
+    temporary = workspace is None
+    workspace = workspace or tempfile.mkdtemp(prefix='covid19_benchmark_')
+
+    # Local storage only, with every output path inside the workspace
+    Utilities.DATABASE = os.environ['DATABASE'] = 'local'
+    Utilities.STORAGE = None
+    os.environ['PATH'] = workspace + '/raw'
+    os.environ['FLAT_FILES_PATH'] = flat_files
+    for folder, name in [('PROCESSED_PATH', 'processed'), ('WEEKLY_DATA_PATH', 'weekly_data'),
+                         ('DAILY_DATA_PATH', 'aggregate'), ('TEMP_PATH', 'intermediary')]:
+        os.environ[folder] = f"{workspace}/{name}"
+        os.makedirs(os.environ[folder], exist_ok=True)
+    Utilities.TEMP_PATH = os.environ['TEMP_PATH']
+    os.environ['TIMEZONE'] = os.getenv('TIMEZONE', Utilities.TIMEZONE)
+
+    # Reverse geocoding by the stub server, without rate limit
+    server = start_stub_geocoder()
+    os.environ['GEOCODE_URL'] = 'http://127.0.0.1:{}/geocode/json'.format(server.server_port)
+    os.environ['GEOCODE_MODE'] = 'google'
+    os.environ['GEOCODE_RATE_LIMIT'] = '1000000'
+    os.environ['GOOGLE_API_KEY'] = 'benchmark'
+
+    try:
+        results = run_benchmark(workspace, rows, files, seed)
+    finally:
+        server.shutdown()
+        if temporary:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    regressions = []
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline['params'] != {'rows': rows, 'files': files, 'seed': seed}:
+            print('\nBaseline was recorded with different parameters: {}'.format(baseline['params']))
+        regressions = compare(results, baseline['results'], tolerance)
+    else:
+        print('\nNo baseline found at {}'.format(baseline_path))
+
+    if update_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump({'params': {'rows': rows, 'files': files, 'seed': seed}, 'results': results}, f, indent=2)
+        print('Baseline stored at {}'.format(baseline_path))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, help='Configuration Path',
+                        required=True)
+    parser.add_argument('-f', '--flat_files', type=str, help='Flat files folder (by default, of the configuration)',
+                        default=None)
+    parser.add_argument('-b', '--baseline', type=str, help='Baseline results (json)',
+                        default='benchmark_baseline.json')
+    parser.add_argument('-n', '--rows', type=int, help='Number of synthetic tweets per raw file',
+                        default=100000)
+    parser.add_argument('-k', '--files', type=int, help='Number of raw files',
+                        default=1)
+    parser.add_argument('-s', '--seed', type=int, help='Random seed of the synthetic tweets',
+                        default=0)
+    parser.add_argument('-t', '--tolerance', type=float, help='Allowed slow down ratio e.g. 0.2 for 20%%',
+                        default=0.2)
+    parser.add_argument('-u', '--update_baseline', type=eval, help='Store the results as the new baseline',
+                        choices=[True, False], default=False)
+    parser.add_argument('-w', '--workspace', type=str, help='Folder for the benchmark files (kept after the run)',
+                        default=None)
+    args = parser.parse_args()
+    load_config(args.config)
+
+    regressions = main(args.flat_files or os.getenv('FLAT_FILES_PATH'), args.baseline, args.rows, args.files,
+                       args.seed, args.tolerance, args.update_baseline, args.workspace)
+    if len(regressions) > 0:
+        print('Regression in: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+    print('DONE')
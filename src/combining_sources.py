@@ -0,0 +1,154 @@
+# Description: In this script, we're combining day level emotions of tweets with Covid cases and deaths of
+# each state i.e. one table keyed by "date" and "state".
+
+import hashlib
+import os
+import argparse
+import pandas as pd
+from Utilities import load_config, list_file_properties, retrieve_file, store_file, exists
+
+# Global Variables
+PROCESSED_PATH = ''
+DAILY_DATA_PATH = ''
+COMBINED_FILE = 'Combined_Emotions_Covid.csv'
+COVID_FILE = 'CovidCasesDeaths_Processed.csv'
+# Version of each file of both the sources and checksum of each date of these files, as of the last run.
+INDEX_FILE = 'Combined_Index.pkl'
+KEYS = ['date', 'state']
+SOURCES = ['emotions', 'covid']
+
+
+def update_global_variables():
+    global PROCESSED_PATH, DAILY_DATA_PATH
+    PROCESSED_PATH = os.getenv('PROCESSED_PATH')
+    DAILY_DATA_PATH = os.getenv('DAILY_DATA_PATH')
+
+
+def source_versions(storage_type):
+    """
+    :param str storage_type: ("single", "daily") storage type of the day level aggregation
+    :return: dictionary of source -> file -> version (size and modified time or etag) of each file
+    """
+    daily = list_file_properties(DAILY_DATA_PATH)
+    if storage_type == 'daily':
+        emotions = {filename: props for filename, props in daily.items() if filename.endswith('_tweets.csv')}
+    else:
+        emotions = {filename: props for filename, props in daily.items() if filename == 'Day_Level_Agg.csv'}
+    covid = {filename: props for filename, props in list_file_properties(PROCESSED_PATH).items()
+             if filename == COVID_FILE}
+    return {source: {filename: '{}_{}'.format(props['size'], props['version']) for filename, props in files.items()}
+            for source, files in [('emotions', emotions), ('covid', covid)]}
+
+
+def emotions_info(filename):
+    """
+    :param str filename: day level aggregation file i.e. "Day_Level_Agg.csv" or a daily file
+    :return: day level emotions of each state
+    """
+    return retrieve_file(DAILY_DATA_PATH, filename, sep='\t')
+
+
+def covid_info():
+    """
+    :return: day-wise Covid cases, deaths and other features of each state
+    """
+    return retrieve_file(PROCESSED_PATH, COVID_FILE)
+
+
+def read_source(source, filename):
+    df = emotions_info(filename) if source == 'emotions' else covid_info()
+    df['date'] = df['date'].astype(str)
+    df['state'] = df['state'].astype(str)
+    return df
+
+
+def date_checksums(df):
+    """
+    :param df: dataframe with "date" and "state" columns
+    :return: dictionary of date -> checksum of all the records of that date
+    """
+    df = df.sort_values(KEYS)
+    row_hashes = pd.util.hash_pandas_object(df, index=False).values
+    return {d: hashlib.md5(row_hashes[positions]).hexdigest() for d, positions in df.groupby('date').indices.items()}
+
+
+def combine(incremental=True, storage_type='single'):
+    """
+    Joining day level emotions with Covid cases and deaths on ("date", "state"). Both sources are indexed on
+    these keys and only the dates which have changed in either source since the last run are joined again
+    and upserted into the combined table. Files of the sources whose version hasn't changed aren't read,
+    unless they have any of these dates.
+
+    :param bool incremental: join only the changed dates or all dates
+    :param str storage_type: ("single", "daily") storage type of the day level aggregation
+    :return: None
+    """
+    versions = source_versions(storage_type)
+    incremental = incremental and exists(f'{DAILY_DATA_PATH}/{COMBINED_FILE}') and \
+        exists(f'{PROCESSED_PATH}/{INDEX_FILE}')
+    previous = {'versions': {source: {} for source in SOURCES}, 'checksums': {source: {} for source in SOURCES}}
+    if incremental:
+        previous = retrieve_file(PROCESSED_PATH, INDEX_FILE)
+
+    # Checksums of the dates of each file. Only new or changed files are read.
+    data = {source: {} for source in SOURCES}
+    checksums = {source: {} for source in SOURCES}
+    for source in SOURCES:
+        for filename, version in versions[source].items():
+            if version == previous['versions'][source].get(filename):
+                checksums[source][filename] = previous['checksums'][source][filename]
+            else:
+                data[source][filename] = read_source(source, filename)
+                checksums[source][filename] = date_checksums(data[source][filename])
+
+    dates = set()
+    for source in SOURCES:
+        current = {d: checksum for file_checksums in checksums[source].values()
+                   for d, checksum in file_checksums.items()}
+        if incremental:
+            last = {d: checksum for file_checksums in previous['checksums'][source].values()
+                    for d, checksum in file_checksums.items()}
+            dates.update(d for d in set(current) | set(last) if current.get(d) != last.get(d))
+        else:
+            dates.update(current)
+
+    if len(dates) > 0:
+        print('Combining {} date(s)'.format(len(dates)))
+        # Unchanged files are read only if they have any of the dates to be joined.
+        frames = {}
+        for source in SOURCES:
+            for filename, file_checksums in checksums[source].items():
+                if filename not in data[source] and len(dates.intersection(file_checksums)) > 0:
+                    data[source][filename] = read_source(source, filename)
+            frames[source] = [df[df['date'].isin(dates)] for _, df in sorted(data[source].items())]
+            frames[source] = pd.concat(frames[source], axis=0, sort=False).set_index(KEYS) \
+                if len(frames[source]) > 0 else pd.DataFrame(columns=KEYS).set_index(KEYS)
+
+        # Indexed (outer) join of both the sources for the changed dates only
+        combined_df = frames['emotions'].join(frames['covid'], how='outer').reset_index()
+
+        if incremental:
+            previous_df = retrieve_file(DAILY_DATA_PATH, COMBINED_FILE, sep='\t')
+            previous_df['date'] = previous_df['date'].astype(str)
+            combined_df = pd.concat([previous_df[~previous_df['date'].isin(dates)], combined_df], axis=0, sort=False)
+        combined_df = combined_df.sort_values(KEYS).reset_index(drop=True)
+        store_file(combined_df, DAILY_DATA_PATH, COMBINED_FILE, sep='\t')
+    else:
+        print('No new date to be combined.')
+
+    # Index is stored only after the combined table is updated.
+    store_file({'versions': versions, 'checksums': checksums}, PROCESSED_PATH, INDEX_FILE)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, help='Configuration File Path',
+                        required=True)
+    parser.add_argument('-i', '--incremental', type=eval, help='Incremental Status',
+                        choices=[True, False], default=True)
+    parser.add_argument('-s', '--storage', type=str.lower, help='Storage Type of the day level aggregation',
+                        choices=["single", "daily"], default="single")
+    args = parser.parse_args()
+    load_config(args.config)
+    update_global_variables()
+    combine(args.incremental, args.storage)
+    print('DONE')
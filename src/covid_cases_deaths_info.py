@@ -4,11 +4,16 @@ import pandas as pd
 import numpy as np
 import requests
 import os
-from Utilities import load_config, store_file, retrieve_file
+from Utilities import load_config, store_file, retrieve_file, exists
 
 PROCESSED_PATH = ''
 WEEKLY_DATA_PATH = ''
 FLAT_FILES_PATH = ''
+COVID_API_URL = 'https://api.covidtracking.com/v1/states/daily.csv'
+REQUEST_TIMEOUT = 60
+# ETag and Last-Modified headers of the last response
+VALIDATORS_FILE = 'covid_api_validators.pkl'
+COUNT_COLUMNS = ['positiveIncrease', 'negativeIncrease', 'hospitalizedIncrease', 'recovered', 'deathIncrease']
 
 
 def population_info():
@@ -16,8 +21,8 @@ def population_info():
     pop = retrieve_file(FLAT_FILES_PATH, "PopulationEstimates.xls", skiprows=2,
                         usecols=['State', 'POP_ESTIMATE_2019'])
     pop = pop[pop['State'] != 'US']
-    pop = pd.DataFrame(pop.groupby('State').apply(lambda x: x['POP_ESTIMATE_2019'].iloc[0]),
-                       columns=['Population']).reset_index()
+    # First estimate of each state
+    pop = pop.drop_duplicates('State').rename(columns={'POP_ESTIMATE_2019': 'Population'})
     pop['Population'] = pop['Population'].astype('int')
 
     # Population of each USA Commonwealth and Territories
@@ -35,37 +40,76 @@ def population_info():
     return pop
 
 
-def covid_api():
-    # Population Info
-    pop = population_info()
+def normalize_by_population(covid_cases, pop):
+    """
+    Normalizing Covid Cases, deaths and other features w.r.t population data i.e. per 1M people of the state.
+
+    :param covid_cases: dataframe with date, state and the count columns
+    :param pop: dictionary of state -> population
+    :return: dataframe with date, state, normalized columns ("*_per_1M") and the original count columns
+    """
+    population = covid_cases['state'].map(pop)
+    covid_info = (covid_cases[COUNT_COLUMNS] * 1000000).floordiv(population, axis=0)
+    covid_info.columns = np.array(covid_info.columns) + '_per_1M'
+    covid_info = pd.concat([covid_cases[['date', 'state']], covid_info], axis=1)
+    # Combining normalized and original columns
+    return pd.concat([covid_info, covid_cases.drop(['date', 'state'], axis=1)], axis=1)
+
+
+def covid_api(incremental=True):
+    """
+    Downloading day-wise Covid cases, deaths and other features of all the states. Validators (ETag and
+    Last-Modified) of the last response are sent with the request, so nothing is downloaded if the data hasn't
+    changed. In incremental mode, only dates newer than the latest date of "CovidCasesDeaths_Processed.csv" are
+    appended to it.
+
+    :param incremental: Bool value defines whether to update the processed file or to create it again.
+    :return: None
+    """
+    incremental = incremental and exists(f"{PROCESSED_PATH}/CovidCasesDeaths_Processed.csv")
+    headers = {}
+    if incremental and exists(f"{PROCESSED_PATH}/{VALIDATORS_FILE}"):
+        validators = retrieve_file(PROCESSED_PATH, VALIDATORS_FILE)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
     # Covid Cases, Deaths and Recovered info for all states day-wise
-    req = requests.get('https://api.covidtracking.com/v1/states/daily.csv')
-    url_content = req.content
-    api_df = pd.read_csv(io.StringIO(url_content.decode('utf-8')))
+    req = requests.get(COVID_API_URL, headers=headers, timeout=REQUEST_TIMEOUT)
+    if req.status_code == 304:
+        print('Covid data has not been modified since the last run.')
+        return
+    req.raise_for_status()
+    # Response is parsed in memory; the raw file is only stored for reference.
+    api_df = pd.read_csv(io.BytesIO(req.content))
     store_file(api_df, FLAT_FILES_PATH, 'CovidCasesDeaths.csv')
+    covid_cases = api_df[[c for c in api_df.columns if c in ['date', 'state'] + COUNT_COLUMNS]].copy()
     del api_df
-    covid_cases = retrieve_file(FLAT_FILES_PATH, 'CovidCasesDeaths.csv',
-                                usecols=['date', 'state', 'positiveIncrease', 'negativeIncrease',
-                                         'hospitalizedIncrease', 'recovered', 'deathIncrease'])
     covid_cases['date'] = pd.to_datetime(covid_cases['date'], format='%Y%m%d')
 
-    # Normalizing Covid Cases, deaths and other features w.r.t population data
-    col = ['positiveIncrease', 'negativeIncrease', 'hospitalizedIncrease', 'recovered', 'deathIncrease']
-    covid_info = covid_cases.groupby(['date', 'state']).apply(lambda x: (x[col]*1000000 // pop[x['state'].iloc[0]]))
-    covid_info.columns = np.array(covid_info.columns) + '_per_1M'
-    covid_info = pd.concat([covid_cases[['date', 'state']], covid_info], axis=1)
-    # Combining normalized and original columns
-    covid_info = pd.concat([covid_info, covid_cases.drop(['date', 'state'], axis=1)], axis=1)
+    if incremental:
+        last_date = retrieve_file(PROCESSED_PATH, 'CovidCasesDeaths_Processed.csv', usecols=['date'])['date'].max()
+        covid_cases = covid_cases[covid_cases['date'] > pd.Timestamp(last_date)]
+        print('{} new record(s) after {}'.format(len(covid_cases), last_date))
+
+    if len(covid_cases) > 0:
+        covid_info = normalize_by_population(covid_cases, population_info())
+        # Storing
+        store_file(covid_info, PROCESSED_PATH, 'CovidCasesDeaths_Processed.csv', mode='a' if incremental else 'w',
+                   header=not incremental)
 
-    # Storing
-    store_file(covid_info, PROCESSED_PATH, 'CovidCasesDeaths_Processed.csv')
+    # Validators are stored only after the processed file is updated.
+    store_file({'etag': req.headers.get('ETag'), 'last_modified': req.headers.get('Last-Modified')},
+               PROCESSED_PATH, VALIDATORS_FILE)
 
 
 def update_global_variables():
-    global PROCESSED_PATH, WEEKLY_DATA_PATH, FLAT_FILES_PATH
+    global PROCESSED_PATH, WEEKLY_DATA_PATH, FLAT_FILES_PATH, COVID_API_URL
     PROCESSED_PATH = os.getenv('PROCESSED_PATH')
     WEEKLY_DATA_PATH = os.getenv('WEEKLY_DATA_PATH')
     FLAT_FILES_PATH = os.getenv('FLAT_FILES_PATH')
+    COVID_API_URL = os.getenv('COVID_API_URL', COVID_API_URL)
 
 
 if __name__ == '__main__':
@@ -73,7 +117,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', type=str.lower, help='Configuration Path',
                         required=True)
+    parser.add_argument('-i', '--incremental', type=eval, help='Incremental Status',
+                        choices=[True, False], default=True)
     args = parser.parse_args()
     load_config(args.config)
     update_global_variables()
-    covid_api()
+    covid_api(args.incremental)
@@ -4,13 +4,28 @@ import sys
 import pandas as pd
 import datetime
 import os
-from Utilities import load_config, list_files, retrieve_file, store_file, exists
+import hashlib
+from Utilities import load_config, list_files, list_file_properties, retrieve_file, store_file, exists, remove_file
 import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
 # Global Variables
 PROCESSED_PATH = ''
 WEEKLY_DATA_PATH = ''
 DAILY_DATA_PATH = ''
+EMOTIONS = ['positive', 'trust', 'anger', 'fear', 'negative', 'sadness', 'anticipation', 'joy', 'surprise', 'disgust']
+# Sum and count of every emotion per week, date and state; aggregates are merged from these partial states.
+PARTIALS_FILE = 'Day_Level_Partials.csv'
+# Checksum of each daily file written by "store_daily_partitions".
+PARTITIONS_FILE = 'Daily_Partitions.pkl'
+# Format and version of each weekly file the partial states were computed from.
+FILES_FILE = 'Day_Level_Files.pkl'
+# Only these columns of the weekly files are parsed.
+REQ_COLS = ['status_id', 'country', 'date', 'state'] + EMOTIONS
+REQ_DTYPES = dict({'status_id': str, 'country': str, 'date': str, 'state': str},
+                  **{emotion: 'float64' for emotion in EMOTIONS})
 
 
 def update_global_variables():
@@ -20,59 +35,193 @@ def update_global_variables():
     DAILY_DATA_PATH = os.getenv('DAILY_DATA_PATH')
 
 
-def agg_at_daily_level(storage_type, incremental=True):
+def week_key(filename, input_format, current_year):
+    """
+    :param filename: weekly file i.e. "Week{week}_..." (csv) or "week={week}/..../{file}.parquet" (parquet)
+    :param input_format: ("csv", "parquet") format of the weekly files
+    :param current_year: current year (string)
+    :return: week number (year followed by week)
+    """
+    if input_format == 'parquet':
+        return int(current_year) * 100 + int(filename.split('/')[0].split('=')[1])
+    return int(current_year) * 100 + int(filename.split('_')[0][4:])
+
+
+def weekly_files(input_format, current_year):
+    """
+    :param input_format: ("csv", "parquet") format of the weekly files
+    :param current_year: current year (string)
+    :return: dictionary with week number (year followed by week) as key and list of files of that week as value,
+    and dictionary of file -> version (size and modified time or etag) of each file
+    """
+    properties = list_file_properties(WEEKLY_DATA_PATH, format=input_format, recursive=input_format == 'parquet')
+    weeks = defaultdict(list)
+    versions = {}
+    for filename, props in properties.items():
+        weeks[week_key(filename, input_format, current_year)].append(filename)
+        versions[filename] = '{}_{}'.format(props['size'], props['version'])
+    return weeks, versions
+
+
+def read_weekly_file(filename, input_format='csv'):
+    print(filename)
+    if input_format == 'parquet':
+        return retrieve_file(WEEKLY_DATA_PATH, filename, usecols=REQ_COLS)
+    return retrieve_file(WEEKLY_DATA_PATH, filename, sep='\t', usecols=REQ_COLS, dtype=REQ_DTYPES)
+
+
+def partial_aggregates(df, week_num):
+    """
+    Partial state of the day level aggregation i.e. sum and count of each emotion per date and state. Unlike
+    means, partial states of different weeks (or files) can be added together.
+
+    :param df: tweets of the week
+    :param week_num: week number (year followed by week)
+    :return: dataframe with week, date, state and "{emotion}_sum", "{emotion}_count" columns
+    """
+    df = df[~df.duplicated()]
+    df = df[df['country'].isin(['US', 'United States'])]
+    df = df[~df['state'].isnull()].reindex(columns=['date', 'state'] + EMOTIONS)
+    df['date'] = df['date'].astype(str)
+    grouped = df.groupby(['date', 'state'])[EMOTIONS].agg(['sum', 'count'])
+    grouped.columns = ['{}_{}'.format(emotion, func) for emotion, func in grouped.columns]
+    grouped = grouped.reset_index()
+    grouped.insert(0, 'week', week_num)
+    return grouped
+
+
+def merge_partials(partials, dates):
+    """
+    :param partials: partial states of all weeks
+    :param dates: dates to be aggregated
+    :return: mean of each emotion per date and state
+    """
+    partials = partials[partials['date'].isin(dates)]
+    totals = partials.drop(columns='week').groupby(['date', 'state']).sum()
+    agg = pd.DataFrame({emotion: totals['{}_sum'.format(emotion)] / totals['{}_count'.format(emotion)]
+                        for emotion in EMOTIONS}, index=totals.index)
+    return agg.reset_index()
+
+
+def store_daily_partitions(combined_df, workers=4, removed_dates=()):
+    """
+    Writing each date of the aggregate into its own file i.e. "{date}_tweets.csv". The frame is split by date in
+    one pass and files are written by a pool of threads. A file is skipped if its content hasn't changed since
+    it was last written.
+
+    :param combined_df: day level aggregate
+    :param int workers: number of files written at once
+    :param removed_dates: dates which don't have any tweet anymore i.e. their files are removed
+    :return: None
+    """
+    checksums = {}
+    if exists('{}/{}'.format(PROCESSED_PATH, PARTITIONS_FILE)):
+        checksums = retrieve_file(PROCESSED_PATH, PARTITIONS_FILE)
+    existing_files = set(list_files(DAILY_DATA_PATH))
+
+    partitions = []
+    for d, date_record in combined_df.groupby('date', sort=True):
+        filename = '{}_tweets.csv'.format(d)
+        checksum = hashlib.md5(pd.util.hash_pandas_object(date_record, index=False).values).hexdigest()
+        if checksums.get(filename) != checksum or filename not in existing_files:
+            partitions.append((filename, date_record, checksum))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(lambda partition: store_file(partition[1], DAILY_DATA_PATH, partition[0], sep='\t'),
+                          partitions))
+    print('Stored {} daily file(s), {} unchanged'.format(len(partitions),
+                                                         combined_df['date'].nunique() - len(partitions)))
+
+    for filename, _, checksum in partitions:
+        checksums[filename] = checksum
+    for d in removed_dates:
+        filename = '{}_tweets.csv'.format(d)
+        checksums.pop(filename, None)
+        if filename in existing_files:
+            remove_file('{}/{}'.format(DAILY_DATA_PATH, filename))
+    store_file(checksums, PROCESSED_PATH, PARTITIONS_FILE)
+
+
+def agg_at_daily_level(storage_type, incremental=True, input_format='csv', workers=4):
     """
     Aggregating at day level and storing in single or daily format based on given storage_type.
     :param str storage_type: ("single", "daily") this indicates whether we want to store a single file or
                                 break it at day-level
     :param bool incremental: process all files or just the new files
+    :param str input_format: ("csv", "parquet") format of the weekly files written by "tweets_processing.py"
+    :param int workers: number of weekly files fetched and parsed (or daily files written) at once
     :return: None
     """
 
-    filenames = list_files(WEEKLY_DATA_PATH, format='csv')
     current_year = str(datetime.date.today().year)
+    weeks, versions = weekly_files(input_format, current_year)
 
-    if len(filenames) == 0:
+    if len(weeks) == 0:
         print('No file exists. Kindly add files in WEEKLY_DATA_PATH')
         sys.exit(0)
 
-    if incremental and exists('{}/Last_Week_Processed.pkl'.format(PROCESSED_PATH)):
-        file_list = []
-        max_week_num = retrieve_file(PROCESSED_PATH, 'Last_Week_Processed.pkl')
-        for filename in filenames:
-            week_num = int(current_year + filename.split('_')[0][4:])
-            if week_num >= max_week_num:
-                file_list.append(filename)
-        filenames = file_list
+    # Partial states are reused only if they were computed from the weekly files of the same format.
+    previous_versions = {}
+    if exists('{}/{}'.format(PROCESSED_PATH, FILES_FILE)):
+        previous_files = retrieve_file(PROCESSED_PATH, FILES_FILE)
+        if previous_files['format'] == input_format:
+            previous_versions = previous_files['files']
+    incremental = incremental and exists('{}/{}'.format(PROCESSED_PATH, PARTIALS_FILE)) and \
+        len(previous_versions) > 0
+
+    # Weeks are read again if any of their files is new, changed (appended) or removed since the last run.
+    if incremental:
+        changed_weeks = set(week_key(filename, input_format, current_year) for filename in
+                            set(versions) | set(previous_versions)
+                            if versions.get(filename) != previous_versions.get(filename))
     else:
-        max_week_num = int(current_year + '00')
+        changed_weeks = set(weeks)
+    weeks = {week_num: files for week_num, files in weeks.items() if week_num in changed_weeks}
+
+    if len(changed_weeks) == 0:
+        print('No new week to be processed.')
+        return
+
     combined = []
     print("Processing following file(s):")
-    for filename in filenames:
-        print(filename)
-        week_num = int(current_year + filename.split('_')[0][4:])
-        if max_week_num < week_num:
-            max_week_num = week_num
-        df = retrieve_file(WEEKLY_DATA_PATH, filename, sep='\t')
-        df = df[~df.duplicated()]
-        df = df[df['country'].isin(['US', 'United States'])]
-        req_cols = (['date', 'state', 'positive', 'trust', 'anger', 'fear', 'negative',
-                    'sadness', 'anticipation', 'joy', 'surprise', 'disgust'])
-        cols_list = list(set(df.columns).intersection(req_cols))
-        df = df[~df['state'].isnull()][cols_list]
-        grouped = df.groupby(['date', 'state'], as_index=False).mean().reset_index()
-        combined.append(grouped)
-
-    combined_df = pd.concat(combined, axis=0, sort=False)
+    # Weekly files are read by a pool of threads, in the same order as they are listed.
+    tasks = [(week_num, filename) for week_num, filenames in weeks.items() for filename in filenames]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        weekly_dfs = executor.map(lambda task: read_weekly_file(task[1], input_format), tasks)
+        # All the files (partitions) of a week are aggregated together
+        for week_num, week_files in groupby(zip(tasks, weekly_dfs), key=lambda item: item[0][0]):
+            df = pd.concat([weekly_df for _, weekly_df in week_files], axis=0, sort=False)
+            combined.append(partial_aggregates(df, week_num))
+
+    # Upserting partial states i.e. replacing the partial states of the changed weeks. Partial states of the
+    # weeks without any file are dropped.
+    partials = pd.concat(combined, axis=0, sort=False) if len(combined) > 0 else \
+        pd.DataFrame(columns=['week', 'date', 'state'])
+    # Days of the changed weeks (before and after the change) are aggregated again.
+    dates = set(partials['date'])
+    if incremental:
+        previous = retrieve_file(PROCESSED_PATH, PARTIALS_FILE, sep='\t')
+        previous['date'] = previous['date'].astype(str)
+        replaced = previous['week'].isin(list(changed_weeks))
+        dates.update(previous.loc[replaced, 'date'])
+        partials = pd.concat([previous[~replaced], partials], axis=0, sort=False)
+    partials = partials.sort_values(['week', 'date', 'state']).reset_index(drop=True)
+    store_file(partials, PROCESSED_PATH, PARTIALS_FILE, sep='\t')
+
+    combined_df = merge_partials(partials, dates)
+
     if storage_type == 'single':
+        if incremental and exists('{}/Day_Level_Agg.csv'.format(DAILY_DATA_PATH)):
+            previous = retrieve_file(DAILY_DATA_PATH, 'Day_Level_Agg.csv', sep='\t')
+            previous['date'] = previous['date'].astype(str)
+            combined_df = pd.concat([previous[~previous['date'].isin(dates)], combined_df], axis=0, sort=False)
+        combined_df = combined_df.sort_values(['date', 'state']).reset_index(drop=True)
         store_file(combined_df, DAILY_DATA_PATH, 'Day_Level_Agg.csv', sep='\t')
     elif storage_type == 'daily':
-        for d in combined_df['date'].unique():
-            date_record = combined_df[combined_df['date'] == d]
-            store_file(date_record, DAILY_DATA_PATH, '{}_tweets.csv'.format(d), sep='\t')
-
-    store_file(max_week_num, PROCESSED_PATH, 'Last_Week_Processed.pkl')
+        store_daily_partitions(combined_df, workers, dates - set(combined_df['date']))
 
+    # Versions are stored only after the aggregates are updated.
+    store_file({'format': input_format, 'files': versions}, PROCESSED_PATH, FILES_FILE)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -82,8 +231,12 @@ if __name__ == '__main__':
                         choices=[True, False], default=True)
     parser.add_argument('-s', '--storage', type=str.lower, help='Storage Type',
                         choices=["single", "daily"], required=True)
+    parser.add_argument('-f', '--format', type=str.lower, help='Format of the weekly files',
+                        choices=["csv", "parquet"], default="csv")
+    parser.add_argument('-w', '--workers', type=int, help='Number of files read or written in parallel',
+                        default=4)
     args = parser.parse_args()
     load_config(args.config)
     update_global_variables()
-    agg_at_daily_level(args.storage, args.incremental)
+    agg_at_daily_level(args.storage, args.incremental, args.format, args.workers)
     print('DONE')
@@ -1,35 +1,174 @@
 # NRC Classifier
 from collections import defaultdict, Counter
 import pandas as pd
+import numpy as np
 import csv
+import re
+import time
+import glob
+from multiprocessing import Pool
 from nltk.tokenize import TweetTokenizer
-from Utilities import retrieve_file
+from Utilities import load_config, retrieve_file, get_checksum
+import Utilities
 import os
 import warnings
 warnings.simplefilter('ignore')
 
 # Global Variables
 FLAT_FILES_PATH = os.getenv('FLAT_FILES_PATH')
+LEXICON = "NRC-emotion-lexicon-wordlevel-alphabetized-v0.92.txt"
+EMOTIONS = ['fear', 'trust', 'anger', 'disgust', 'negative',
+            'positive', 'joy', 'anticipation', 'surprise', 'sadness']
+
+# "cleaned_text" only keeps [0-9A-Za-z ] characters. For such text a whitespace split gives the same words as
+# TweetTokenizer, so we can skip the (slow) tokenizer regex for it. Letters followed by digits are split as
+# TweetTokenizer does ("covid19" -> "covid", "19") only if there are at least 3 letters; otherwise TweetTokenizer
+# may keep the token as it is ("ab8") or read it as an emoticon ("do8").
+ALPHA_TOKEN = re.compile(r'([A-Za-z]+)')
+WORD_TOKEN = re.compile(r'([A-Za-z]+)(?:(?<=[A-Za-z]{3})[0-9]+)?')
+DIGIT_TOKEN = re.compile(r'[0-9]+')
+
+# Emotions object of a pool worker. It's set once per worker by "init_worker" so the lexicon isn't reloaded per chunk.
+WORKER_EMOTIONS = None
+
+
+def init_worker(emotions):
+    global WORKER_EMOTIONS
+    WORKER_EMOTIONS = emotions
+
+
+def score_chunk(text):
+    return WORKER_EMOTIONS.emotion_scoring(text)
+
+
+def split_tokens(text, tokenizer, keep_digits=False):
+    """
+    Splitting tweets into words with vectorized string operations. Tweets having any other kind of token (e.g.
+    non-ASCII characters) are tokenized by "tokenizer" instead, so the words are always the same as
+    TweetTokenizer's; only numbers are dropped unless "keep_digits" is set.
+
+    :param text: a pandas series (or list) of cleaned tweets
+    :param tokenizer: TweetTokenizer object
+    :param keep_digits: keep numbers as TweetTokenizer does i.e. lexicon has numbers
+    :return: a pandas series of tokens indexed by the position of their tweet in "text"
+    """
+    text = pd.Series(list(text), dtype=object)
+    tokens = text.str.split().explode()
+    tokens = tokens[tokens.notnull()]
+
+    # Every distinct token is matched only once.
+    codes, uniques = pd.factorize(tokens)
+    pattern = ALPHA_TOKEN if keep_digits else WORD_TOKEN
+    matches = [pattern.fullmatch(token) for token in uniques]
+    words = np.array([m.group(1) if m is not None else '' for m in matches], dtype=object)
+    is_word = np.array([m is not None for m in matches], dtype=bool)
+    other = ~is_word & np.array([keep_digits or DIGIT_TOKEN.fullmatch(token) is None for token in uniques],
+                                dtype=bool)
+    fallback = np.unique(tokens.index.values[other[codes]])
+    keep = is_word[codes] & ~np.isin(tokens.index.values, fallback)
+    words = pd.Series(words[codes[keep]], index=tokens.index.values[keep], dtype=object)
+    if len(fallback) == 0:
+        return words
+    fallback_tokens = pd.Series([tokenizer.tokenize(text[i]) for i in fallback], index=fallback).explode()
+    return pd.concat([words, fallback_tokens[fallback_tokens.notnull()]], axis=0)
+
+
+def artifact_path():
+    # Memory mapping needs a local file, so on azure the artifact lives in the temp folder.
+    if Utilities.DATABASE == 'azure':
+        return os.getenv('TEMP_PATH')
+    return os.getenv('PROCESSED_PATH')
+
+
+def compile_lexicon():
+    """
+    Compiling the NRC text file into a binary artifact i.e. a sorted array of words along with a bitmask
+    of their emotions (bit "k" is set if the word belongs to k-th emotion of EMOTIONS). Artifact is named after
+    the checksum of the text file so it's rebuilt only when the lexicon changes.
+
+    :return: path of the compiled artifact
+    """
+    checksum = get_checksum(f"{FLAT_FILES_PATH}/{LEXICON}")
+    path = artifact_path()
+    artifact = f"{path}/NRC_lexicon_{checksum}.npy"
+    if os.path.exists(artifact):
+        return artifact
+
+    print(" Compiling NRC lexicon")
+    masks = defaultdict(int)
+    f = retrieve_file(FLAT_FILES_PATH, LEXICON)
+    reader = csv.reader(f, delimiter='\t')
+    headerRows = [i for i in range(0, 2)]
+    for _ in headerRows:
+        next(reader)
+    for word, emotion, present in reader:
+        if int(present) == 1:
+            masks[word.encode('utf-8')] |= 1 << EMOTIONS.index(emotion)
+    f.close()
+
+    words = sorted(masks)
+    lexicon = np.zeros(len(words), dtype=[('word', 'S{}'.format(max(map(len, words), default=1))),
+                                          ('mask', 'u2')])
+    lexicon['word'] = words
+    lexicon['mask'] = [masks[w] for w in words]
+
+    # Writing to a temporary file first as other processes might be reading the artifact at the same time.
+    os.makedirs(path, exist_ok=True)
+    temp_file = f"{artifact}.{os.getpid()}.tmp"
+    with open(temp_file, 'wb') as f:
+        np.save(f, lexicon)
+    os.replace(temp_file, artifact)
+    for old_artifact in glob.glob(f"{path}/NRC_lexicon_*.npy"):
+        if old_artifact != artifact:
+            os.remove(old_artifact)
+    return artifact
 
 
 class Emotions:
-    def __init__(self):
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.pool = None
         self.tt = TweetTokenizer()
-        self.wordList = defaultdict(list)
-        self.empty_df = pd.DataFrame(columns=['fear', 'trust', 'anger', 'disgust', 'negative',
-                                              'positive', 'joy', 'anticipation', 'surprise', 'sadness'])
+        self.empty_df = pd.DataFrame(columns=EMOTIONS)
+        self.artifact = compile_lexicon()
         self.emotion_count()
 
     def emotion_count(self):
-        f = retrieve_file(FLAT_FILES_PATH, "NRC-emotion-lexicon-wordlevel-alphabetized-v0.92.txt")
-        reader = csv.reader(f, delimiter='\t')
-        headerRows = [i for i in range(0, 2)]
-        for _ in headerRows:
-            next(reader)
-        for word, emotion, present in reader:
-            if int(present) == 1:
-                self.wordList[word].append(emotion)
-        f.close()
+        # Memory mapped, so the lexicon pages are shared by every process reading the artifact.
+        lexicon = np.load(self.artifact, mmap_mode='r')
+        self.words = lexicon['word']
+        self.masks = lexicon['mask']
+        # Matrix of shape (number of words, 10) where row "i" is a 0/1 vector over the emotions of i-th word.
+        self.matrix = ((self.masks[:, None].astype('int64') >> np.arange(len(EMOTIONS))) & 1)
+        # Digits are only safe to drop in the fast path when no lexicon word is a number.
+        self.has_digit_words = any(w.isdigit() for w in self.words)
+        self._wordList = None
+
+    @property
+    def wordList(self):
+        # Only needed by "emotion_parsing", so it's built on first use.
+        if self._wordList is None:
+            self._wordList = defaultdict(list)
+            for word, row in zip(self.words, self.matrix):
+                self._wordList[word.decode('utf-8')] = [EMOTIONS[k] for k in np.flatnonzero(row)]
+        return self._wordList
+
+    def __getstate__(self):
+        # Process pool can't be shared with the workers and the lexicon is memory mapped again by each worker.
+        state = self.__dict__.copy()
+        for key in ['pool', 'words', 'masks', 'matrix', '_wordList']:
+            state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.emotion_count()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def emotion_parsing(self, text):
         text = self.tt.tokenize(text)
@@ -38,16 +177,83 @@ class Emotions:
             emo_count += Counter(self.wordList[token])
         return emo_count
 
-    def get_emotions(self, text):
+    def emotion_scoring(self, text):
+        """
+        Scoring a whole series of tweets in one pass i.e. a sparse document-term product between the
+        tweets and the emotion matrix.
+
+        :param text: a pandas series object with cleaned tweets.
+        :return: a numpy array of shape (number of tweets, 10) with count of each emotion.
+        """
+        tokens = split_tokens(text, self.tt, self.has_digit_words)
+        scores = np.zeros((len(text), len(EMOTIONS)), dtype='int64')
+        if len(tokens) == 0 or len(self.words) == 0:
+            return scores
+
+        # Looking up each distinct token once in the sorted word array.
+        codes, uniques = pd.factorize(tokens)
+        uniques = np.array([token.encode('utf-8') for token in uniques])
+        positions = np.minimum(np.searchsorted(self.words, uniques), len(self.words) - 1)
+        found = (self.words[positions] == uniques)[codes]
+        doc_ids = tokens.index.values[found].astype('int64')
+        hits = self.matrix[positions[codes[found]]]
+        for k in range(len(EMOTIONS)):
+            scores[:, k] = np.bincount(doc_ids, weights=hits[:, k], minlength=len(text))
+        return scores
+
+    def parallel_scoring(self, text):
+        """
+        Splitting tweets into chunks and scoring them in a process pool. Chunks are returned by the pool in the
+        same order as they were submitted so the result is identical to "emotion_scoring".
+
+        :param text: a pandas series object with cleaned tweets.
+        :return: a numpy array of shape (number of tweets, 10) with count of each emotion.
+        """
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=init_worker, initargs=(self,))
+
+        text = list(text)
+        n_chunks = min(len(text), self.workers * 4)
+        if n_chunks == 0:
+            return self.emotion_scoring(text)
+        bounds = np.linspace(0, len(text), n_chunks + 1).astype('int64')
+        chunks = [text[bounds[i]:bounds[i + 1]] for i in range(n_chunks)]
+        return np.vstack(self.pool.map(score_chunk, chunks))
+
+    def get_emotions(self, text, vectorized=True):
         """
         :param text: a pandas series object with cleaned tweets i.e. no special characters.
+        :param vectorized: score all tweets at once using the emotion matrix. If False, every tweet is parsed
+        separately using "emotion_parsing".
         :return: returning a dataframe with new 10 columns i.e. anger, sad, joy, anticipation,
         fear, positive sentiment, negative sentiment ...
         """
 
         print(" Getting Emotions")
+        if vectorized:
+            started_at = time.time()
+            if self.workers > 1:
+                scores = self.parallel_scoring(text)
+            else:
+                scores = self.emotion_scoring(text)
+            elapsed = max(time.time() - started_at, 1e-6)
+            print("  Scored {} tweets with {} worker(s): {:.0f} tweets/sec".format(len(text), self.workers,
+                                                                                len(text) / elapsed))
+            # Same (float) counts as the "emotion_parsing" path, so the stored files keep their format.
+            return pd.DataFrame(scores.astype('float64'), index=text.index, columns=self.empty_df.columns)
+
         emotion_info = pd.DataFrame(map(self.emotion_parsing, text), index=text.index)
         emotion_info = pd.concat([self.empty_df, emotion_info], axis=0)
         emotion_info.fillna(0, inplace=True)
         return emotion_info
 
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, help='Configuration Path',
+                        required=True)
+    args = parser.parse_args()
+    load_config(args.config)
+    FLAT_FILES_PATH = os.getenv('FLAT_FILES_PATH')
+    print(compile_lexicon())
@@ -6,14 +6,31 @@ import time
 import pandas as pd
 import requests
 import numpy as np
-from Utilities import store_file, retrieve_file, exists
+from Utilities import store_file, retrieve_file, exists, get_modified_time
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import warnings
 warnings.simplefilter('ignore')
 
 FLAT_FILES_PATH = os.getenv('FLAT_FILES_PATH')
 PROCESSED_PATH = os.getenv('PROCESSED_PATH')
 
+# Gazetteer of the current process. It's built (or loaded) once by "get_gazetteer".
+GAZETTEER = None
+# Resolved locations of the current process. It's loaded once by "get_location_cache".
+LOCATION_CACHE = None
+LOCATION_FIELDS = ['city', 'county', 'state', 'country', 'flag']
+# Address information of geocoded coordinates. It's loaded once by "get_geocode_cache".
+GEOCODE_CACHE = None
+# Spatial index over the cities. It's built once by "get_city_index".
+CITY_INDEX = None
+# County names are stored as returned by google api e.g. "Travis County", "Orleans Parish".
+COUNTY_SUFFIXES = (' County', ' Parish', ' Borough', ' Census Area', ' Municipality', ' city', ' City')
+STATE_COUNTY_SUFFIX = {'LA': 'Parish', 'AK': 'Borough'}
+TERRITORIES = {'PR', 'VI', 'GU', 'AS', 'MP'}
+
 
 def city_state_county():
     # Cities Information
@@ -55,83 +72,554 @@ def city_state_county():
     return cities, city_dict, state_dict, county_dict, county_transformed_dict
 
 
-def coord(df, flag='None', col_name='None'):
+class GeocodeCache:
+    """
+    Address information of each coordinate ("{lat}_{lng}" -> address components) stored as an append-only log
+    (address_caching.csv). New addresses are appended in batches instead of rewriting the whole cache, and the log
+    is compacted when it has more duplicate than unique records.
+    """
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self.addresses = {}
+        self.pending = []
+        self.load()
+
+    def load(self):
+        if exists(f"{PROCESSED_PATH}/address_caching.csv"):
+            log = retrieve_file(PROCESSED_PATH, "address_caching.csv", sep='\t')
+            # Later records win, same as updating the dictionary.
+            self.addresses = dict(zip(log['lat_lng'], map(json.loads, log['address'])))
+            if len(log) > 2 * len(self.addresses):
+                self.compact()
+        elif exists(f"{PROCESSED_PATH}/address_caching.pkl"):
+            # One time import of the old pickled cache.
+            print(' Importing address_caching.pkl')
+            self.addresses = retrieve_file(PROCESSED_PATH, "address_caching.pkl")
+            self.compact()
+
+    def get(self, key):
+        return self.addresses.get(key)
+
+    def put(self, key, d):
+        self.addresses[key] = d
+        self.pending.append((key, json.dumps(d)))
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+        create_new_file = not exists(f"{PROCESSED_PATH}/address_caching.csv")
+        store_file(pd.DataFrame(self.pending, columns=['lat_lng', 'address']), PROCESSED_PATH,
+                   "address_caching.csv", sep='\t', mode='a', header=create_new_file)
+        self.pending = []
+
+    def compact(self):
+        log = pd.DataFrame([(k, json.dumps(v)) for k, v in self.addresses.items()], columns=['lat_lng', 'address'])
+        store_file(log, PROCESSED_PATH, "address_caching.csv", sep='\t')
+        self.pending = []
+
+
+def get_geocode_cache():
+    global GEOCODE_CACHE
+    if GEOCODE_CACHE is None:
+        GEOCODE_CACHE = GeocodeCache()
+    return GEOCODE_CACHE
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket i.e. at most "rate" requests per second with bursts of up to "burst" requests.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GeocodingError(Exception):
+    """
+    Geocoding can't be continued at all e.g. request denied (invalid key) or quota exhausted.
+    """
+    pass
+
+
+class RateLimitError(requests.HTTPError):
+    pass
+
+
+class GeocodingClient:
+    """
+    Reverse geocoding client with a shared HTTP session (connection reuse), rate limit, retries with exponential
+    backoff and bounded number of concurrent requests. Endpoint, rate and workers are set in the config file.
+    """
+    def __init__(self, url=None, key=None, rate=None, workers=None, retries=3, backoff=1.0):
+        self.url = url or os.getenv('GEOCODE_URL', 'https://maps.googleapis.com/maps/api/geocode/json')
+        self.key = key or os.getenv('GOOGLE_API_KEY')
+        self.workers = int(workers or os.getenv('GEOCODE_WORKERS', 4))
+        self.rate_limiter = RateLimiter(float(rate or os.getenv('GEOCODE_RATE_LIMIT', 10)))
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def reverse_geocode(self, lat, lng):
+        """
+        :param lat: latitude (string)
+        :param lng: longitude (string)
+        :return: dictionary with address components of the first result or an empty dictionary if nothing is found
+        """
+        URL = self.url + '?latlng=' + lat + ',' + lng + '&key=' + self.key
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(URL, timeout=30)
+                if response.status_code == 429:
+                    raise RateLimitError('429 Error for url: {}'.format(self.url))
+                if response.status_code >= 500:
+                    raise requests.HTTPError('{} Error for url: {}'.format(response.status_code, self.url))
+                response_json = json.loads(response.text)
+                status = response_json.get('status')
+                if status in ('OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT'):
+                    raise RateLimitError('{} for url: {}'.format(status, self.url))
+                if status == 'REQUEST_DENIED':
+                    raise GeocodingError('REQUEST_DENIED for url: {} {}'.format(
+                        self.url, response_json.get('error_message', '')))
+                break
+            except RateLimitError as e:
+                if attempt == self.retries:
+                    raise GeocodingError(str(e))
+                time.sleep(self.backoff * 2 ** attempt)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+        d = {}
+        try:
+            address_json = response_json['results'][0]['address_components']
+        except IndexError:
+            return d
+
+        for j in address_json:
+            d['lat'] = lat
+            d['lng'] = lng
+            types = "_".join(j['types'])
+            d[types + '_long'] = j['long_name']
+            d[types + '_short'] = j['short_name']
+        return d
+
+    def reverse_geocode_all(self, lat_lng):
+        """
+        Addresses are yielded as soon as they're resolved. A failed coordinate (after retries or with an invalid
+        response) is skipped, so it's requested again in the next run, whereas GeocodingError stops all the
+        pending requests.
+
+        :param lat_lng: list of (lat, lng) tuples
+        :return: generator of ((lat, lng), address dictionary) in the order of completion
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(self.reverse_geocode, *x): x for x in lat_lng}
+        failed = 0
+        try:
+            for future in as_completed(futures):
+                try:
+                    d = future.result()
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    failed += 1
+                    print('  Geocoding failed for {}: {}'.format(futures[future], e))
+                    continue
+                yield futures[future], d
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            if failed > 0:
+                print('  Geocoding failed for {} of {} coordinate(s)'.format(failed, len(futures)))
+
+
+class CityIndex:
+    """
+    Grid based spatial index over the coordinates of "uscities.csv" for offline reverse geocoding. Each cell of the
+    grid is "max_distance" km high, so the nearest city within "max_distance" km is always in the neighbouring cells.
+    """
+    def __init__(self, max_distance):
+        cities = retrieve_file(FLAT_FILES_PATH, "uscities.csv",
+                               usecols=['city', 'state_id', 'county_name', 'lat', 'lng'])
+        cities = cities[~cities[['lat', 'lng']].isnull().any(axis=1)].reset_index(drop=True)
+        self.max_distance = max_distance
+        self.cell_size = max_distance / 111.0
+        self.cities = cities
+        self.lat = np.radians(cities['lat'].values)
+        self.lng = np.radians(cities['lng'].values)
+
+        cells = pd.DataFrame({'row': np.floor(cities['lat'] / self.cell_size).astype('int64'),
+                              'col': np.floor(cities['lng'] / self.cell_size).astype('int64')})
+        self.grid = {cell: group.index.values for cell, group in cells.groupby(['row', 'col'])}
+
+    def nearest(self, lat, lng):
+        """
+        :param lat: latitude
+        :param lng: longitude
+        :return: index of the nearest city within "max_distance" km or None
+        """
+        row = int(np.floor(lat / self.cell_size))
+        col = int(np.floor(lng / self.cell_size))
+        # Cells get narrower (in km) away from the equator, so more columns are needed to cover "max_distance".
+        n_cols = int(np.ceil(1 / max(np.cos(np.radians(abs(lat) + self.cell_size)), 0.01)))
+        candidates = [self.grid[(r, c)] for r in range(row - 1, row + 2) for c in range(col - n_cols, col + n_cols + 1)
+                      if (r, c) in self.grid]
+        if len(candidates) == 0:
+            return None
+        candidates = np.concatenate(candidates)
+
+        # Haversine distance
+        lat, lng = np.radians(lat), np.radians(lng)
+        a = np.sin((self.lat[candidates] - lat) / 2) ** 2 + \
+            np.cos(lat) * np.cos(self.lat[candidates]) * np.sin((self.lng[candidates] - lng) / 2) ** 2
+        distance = 2 * 6371 * np.arcsin(np.sqrt(a))
+        i = np.argmin(distance)
+        if distance[i] > self.max_distance:
+            return None
+        return candidates[i]
+
+    def reverse_geocode_all(self, lat_lng):
+        """
+        :param lat_lng: list of (lat, lng) tuples (strings)
+        :return: dictionary of (lat, lng) -> address information, in the same format as google api, for the
+        coordinates which are near to any city
+        """
+        addresses = {}
+        for lat, lng in set(lat_lng):
+            i = self.nearest(float(lat), float(lng))
+            if i is None:
+                continue
+            city = self.cities.iloc[i]
+            addresses[(lat, lng)] = {'lat': lat,
+                                     'lng': lng,
+                                     'locality_political_long': city['city'],
+                                     'administrative_area_level_2_political_long': city['county_name'],
+                                     'administrative_area_level_1_political_short': city['state_id'],
+                                     'country_political_long': 'United States'}
+        return addresses
+
+
+def normalize_county(county, state):
+    """
+    :param county: county name either from "uscities.csv" (e.g. "Travis") or google api (e.g. "Travis County")
+    :param state: state code e.g. "TX"
+    :return: county name with its suffix, in the same format as google api
+    """
+    if (not isinstance(county, str)) or (county == '') or (state in TERRITORIES) or \
+            (county == 'District of Columbia') or county.endswith(COUNTY_SUFFIXES):
+        return county
+    return county + ' ' + STATE_COUNTY_SUFFIX.get(state, 'County')
+
+
+def get_city_index():
+    global CITY_INDEX
+    if CITY_INDEX is None:
+        CITY_INDEX = CityIndex(float(os.getenv('GEOCODE_MAX_DISTANCE', 25)))
+    return CITY_INDEX
+
+
+def bbox_centroids(bbox):
+    """
+    :param bbox: a pandas series with bounding boxes i.e. 4 longitudes followed by 4 latitudes separated by spaces
+    :return: a numpy array of shape (n, 2) with latitude and longitude of the centroid of each bounding box
+    """
+    values = ' '.join(bbox).split()
+    if len(values) == 8 * len(bbox):
+        bbox = np.array(values, dtype='float64').reshape(len(bbox), 8)
+    else:
+        # Malformed bounding boxes; missing values end up as NaN.
+        bbox = bbox.str.split(' ', expand=True).reindex(columns=range(8)).apply(pd.to_numeric, errors='coerce').values
+    return np.column_stack([bbox[:, 4:].mean(axis=1), bbox[:, :4].mean(axis=1)])
+
+
+def geocode(bbox):
     """
     Here we're using Google API for reverse geocoding so basically we're passing LAT and LONG and getting
-    corresponding address information.
+    corresponding address information. Each unique coordinate is resolved only once and then mapped back to
+    every tweet.
+
+    :param bbox: a pandas series with bounding boxes
+    :return: dataframe with lng, lat, city, county, state, country information having the same index as "bbox"
+    """
+    unique_centroids, inverse = np.unique(bbox_centroids(bbox), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    # Caching the address information for each coordinate. This will help us to use the existing
+    # address info instead of calling google api for every coordinate.
+    caching = get_geocode_cache()
+
+    keys = [(str(lat), str(lng)) for lat, lng in unique_centroids]
+
+    # Offline reverse geocoding using the nearest city. Google API is used only for the coordinates which
+    # aren't near to any city.
+    offline = {}
+    if os.getenv('GEOCODE_MODE', 'google') == 'offline':
+        offline = get_city_index().reverse_geocode_all(keys)
+        print('  Offline geocoding: {} of {} coordinate(s) resolved'.format(len(offline), len(keys)))
+
+    # Reverse GeoCoding using Google Maps API for the coordinates which aren't cached.
+    new_keys = [k for k in keys if (k not in offline) and (caching.get(k[0] + '_' + k[1]) is None)]
+    if len(new_keys) > 0:
+        try:
+            for (lat, lng), d in GeocodingClient().reverse_geocode_all(new_keys):
+                if len(d) > 0:
+                    caching.put(lat + '_' + lng, d)
+        except GeocodingError as e:
+            print(e)
+            sys.exit(1)
+        finally:
+            # Addresses resolved so far are cached even if geocoding is stopped.
+            caching.commit()
+
+    lat_lng = [offline.get((lat, lng)) or caching.get(lat + '_' + lng) or {} for lat, lng in keys]
+
+    address_info = pd.DataFrame(lat_lng, columns=['locality_political_long',
+                                                  'administrative_area_level_2_political_long',
+                                                  'administrative_area_level_1_political_short',
+                                                  'country_political_long'])
+    address_info.columns = ['city', 'county', 'state', 'country']
+    # Offline and google api counties in the same format
+    us = address_info['country'] == 'United States'
+    address_info.loc[us, 'county'] = [normalize_county(county, state) for county, state in
+                                      zip(address_info.loc[us, 'county'], address_info.loc[us, 'state'])]
+    address_info.insert(0, 'lng', [k[1] for k in keys])
+    address_info.insert(1, 'lat', [k[0] for k in keys])
+
+    address_info = address_info.iloc[inverse]
+    address_info.index = bbox.index
+    return address_info
+
+
+def coord(df, flag='None', col_name='None'):
+    """
     :param df: a dataframe with location information
     :param flag: it defines the flag where coordinates are present.
     :param col_name: it defines the corresponding column based on location type
     :return: dataframe with city, county, state, country information
     """
-    coord_df = df[df['Flag_Loc'] == flag]
-    coord_df = coord_df[[col_name]]
-    coord_df = coord_df[~coord_df.duplicated()]
-    coord_df = np.array(coord_df[col_name].str.split(' '))
+    df = df[df['Flag_Loc'] == flag].reset_index(drop=True)
+    df = pd.concat([df, geocode(df[col_name])], axis=1)
+    df['flag'] = 'Success'
+    return df
 
-    # Dictionary for caching the address information for each coordinate. This will help us to use the existing
-    # address info instead of calling google api for every coordinate.
-    if exists(f"{PROCESSED_PATH}/address_caching.pkl"):
-        caching = retrieve_file(PROCESSED_PATH, "address_caching.pkl")
-    else:
-        caching = {}
 
-    # Same information as above but we're using LIST here instead of dictionary. So, it's easy to convert it to
-    # dataframe and then can be converted to csv or xlsx or any format.
-    lat_lng = []
+class Gazetteer:
+    """
+    Hash indexes over the cities, counties and states information so that every lookup in "retweetLoc" is O(1).
 
-    # Reverse GeoCoding using Google Maps API
-    for coords in coord_df:
-        lng = str(np.mean(list(map(float, coords[:4]))))
-        lat = str(np.mean(list(map(float, coords[4:]))))
+    city_dict: state -> set of cities
+    county_dict, county_transformed_dict: state -> set of counties
+    state_dict: state name -> abbreviation and abbreviation -> state name
+    city_county: (city, state) -> county
+    city_info: city -> (state, county) of the first matching city in "uscities.csv"
+    """
+    def __init__(self):
+        cities, city_dict, state_dict, county_dict, county_transformed_dict = city_state_county()
 
-        d = {}
+        self.city_dict = {k: set(v) for k, v in city_dict.items()}
+        self.state_dict = state_dict
+        self.county_dict = {k: set(v) for k, v in county_dict.items()}
+        self.county_transformed_dict = {k: set(v) for k, v in county_transformed_dict.items()}
 
-        if caching.get(lat + '_' + lng, 0) != 0:
-            d = caching[lat + '_' + lng]
-        else:
-            try:
-                time.sleep(1)
-                key = os.getenv('GOOGLE_API_KEY')
-                URL = 'https://maps.googleapis.com/maps/api/geocode/json?latlng=' + lat + ',' + lng + '&key=' + key
+        # "drop_duplicates" keeps the first row, same as ".iloc[0]" on the filtered cities.
+        unique_city_state = cities.drop_duplicates(['city', 'state_id'])
+        self.city_county = dict(zip(zip(unique_city_state['city'], unique_city_state['state_id']),
+                                    unique_city_state['county_name']))
+        unique_city = cities.drop_duplicates(['city'])
+        self.city_info = dict(zip(unique_city['city'], zip(unique_city['state_id'], unique_city['county_name'])))
 
-                response = requests.request('GET', URL)
-                address_json = json.loads(response.text)['results'][0]['address_components']
 
-                for j in address_json:
-                    d['lat'] = lat
-                    d['lng'] = lng
-                    types = "_".join(j['types'])
-                    d[types + '_long'] = j['long_name']
-                    d[types + '_short'] = j['short_name']
+class LocationCache:
+    """
+    Bounded LRU cache of resolved locations i.e. raw location string -> (city, county, state, country, flag).
+    It's persisted in PROCESSED_PATH (once per run, see "save_location_cache") so that the same locations aren't
+    resolved again in the next runs.
+    """
+    def __init__(self, source_version, max_size=500000):
+        self.source_version = source_version
+        self.max_size = max_size
+        self.locations = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.updated = False
+
+    def get(self, location):
+        resolved = self.locations.get(location)
+        if resolved is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.locations.move_to_end(location)
+        return dict(zip(LOCATION_FIELDS, resolved))
+
+    def put(self, location, d):
+        self.locations[location] = tuple(d[k] for k in LOCATION_FIELDS)
+        self.locations.move_to_end(location)
+        self.updated = True
+        while len(self.locations) > self.max_size:
+            self.locations.popitem(last=False)
+
+    def report(self):
+        print('  Location cache: {} hit(s), {} miss(es)'.format(self.hits, self.misses))
+        self.hits = 0
+        self.misses = 0
+
+
+def get_location_cache(gazetteer):
+    """
+    Loading the persisted location cache. Cache is discarded if it was built with an older gazetteer.
 
-                caching[lat + '_' + lng] = d
+    :param gazetteer: Gazetteer object
+    :return: LocationCache object
+    """
+    global LOCATION_CACHE
+    if LOCATION_CACHE is None:
+        if exists(f"{PROCESSED_PATH}/location_caching.pkl"):
+            LOCATION_CACHE = retrieve_file(PROCESSED_PATH, "location_caching.pkl")
+        if LOCATION_CACHE is None or LOCATION_CACHE.source_version != gazetteer.source_version:
+            LOCATION_CACHE = LocationCache(gazetteer.source_version)
+    return LOCATION_CACHE
 
-                store_file(caching, PROCESSED_PATH, "address_caching.pkl")
-            except IndexError:
-                pass
-            except Exception as e:
-                print(e)
-                sys.exit(0)
 
-        lat_lng.append(d)
+def save_location_cache():
+    """
+    Storing the location cache in PROCESSED_PATH if any location was added to it in this run.
 
-    address_info = pd.DataFrame(lat_lng)
+    :return: None
+    """
+    if LOCATION_CACHE is None or not getattr(LOCATION_CACHE, 'updated', False):
+        return
+    LOCATION_CACHE.updated = False
+    store_file(LOCATION_CACHE, PROCESSED_PATH, "location_caching.pkl")
 
-    address_info = address_info[['lat', 'lng', 'locality_political_long',
-                                 'administrative_area_level_2_political_long',
-                                 'administrative_area_level_1_political_short',
-                                 'country_political_long']]
-    address_info.columns = ['lat', 'lng', 'city', 'county', 'state', 'country']
 
-    df = df[df['Flag_Loc'] == flag]
+def get_gazetteer():
+    """
+    Gazetteer is built once per process and persisted in PROCESSED_PATH along with the modified time of the flat
+    files it was built from. Later runs load the persisted gazetteer unless any of these flat files have changed.
 
-    df['lng'] = df[col_name].str.split(' ').apply(lambda x: np.mean(list(map(float, x[:4])))).astype(str)
-    df['lat'] = df[col_name].str.split(' ').apply(lambda x: np.mean(list(map(float, x[4:])))).astype(str)
+    :return: Gazetteer object
+    """
+    global GAZETTEER
+    if GAZETTEER is not None:
+        return GAZETTEER
+
+    source_version = [str(get_modified_time(f"{FLAT_FILES_PATH}/{file}"))
+                      for file in ["uscities.csv", "PopulationEstimates.xls"]]
+    if exists(f"{PROCESSED_PATH}/gazetteer.pkl"):
+        cached = retrieve_file(PROCESSED_PATH, "gazetteer.pkl")
+        if cached['source_version'] == source_version:
+            GAZETTEER = cached['gazetteer']
+            GAZETTEER.source_version = source_version
+            return GAZETTEER
+
+    print(' Building Gazetteer')
+    GAZETTEER = Gazetteer()
+    GAZETTEER.source_version = source_version
+    store_file({'source_version': source_version, 'gazetteer': GAZETTEER}, PROCESSED_PATH, "gazetteer.pkl")
+    return GAZETTEER
+
+
+def resolve_location(location, gazetteer):
+    """
+    Extracting city, county, state and country from a free text location e.g. "Austin, TX".
 
-    df = df.merge(address_info, how='left', left_on=['lat', 'lng'], right_on=['lat', 'lng'])
-    df['flag'] = 'Success'
-    return df
+    :param location: location string
+    :param gazetteer: Gazetteer object
+    :return: a dictionary with city, county, state, country and flag
+    """
+    d = dict()
+    for k in ['city', 'county', 'state', 'country', 'flag']:
+        d[k] = ''
+    separated = location.split(',')
+    try:
+        for loc in separated[::-1]:
+
+            loc = re.sub("[^0-9A-Za-z ]", '', loc.strip().lower())
+            loc = loc.replace('saint', 'st.')
+            if (d['country'] == '') and (
+                    loc in ['usa', 'united states', 'us', 'united states of america', 'america']):
+                d['country'] = 'US'
+                d['flag'] = 'Success'
+            elif (d['state'] == '') and (loc in gazetteer.state_dict):
+                d['state'] = (((len(loc) > 2) and gazetteer.state_dict[loc]) or loc)
+                d['country'] = 'US'
+                d['flag'] = 'Success'
+            elif (d['county'] == '') and (d['state'] != '') and (
+                    (loc in gazetteer.county_dict[d['state']]) or
+                    (loc in gazetteer.county_transformed_dict[d['state']])):
+                d['county'] = loc
+                d['flag'] = 'Success'
+            elif (d['state'] != '') and (loc in gazetteer.city_dict[d['state']]):
+                d['city'] = loc
+                d['country'] = 'US'
+                d['county'] = gazetteer.city_county[(loc, d['state'])]
+                d['flag'] = 'Success'
+            elif ((len(separated) == 1) or (d['country'] == 'US')) and (loc in gazetteer.city_info):
+                d['city'] = loc
+                d['country'] = 'US'
+                d['flag'] = 'Success'
+                d['state'], d['county'] = gazetteer.city_info[loc]
+            elif d['flag'] != 'Success':
+                d['flag'] = 'Conditions Not Met'
+    except Exception as e:
+        print(e, "\nContinuing.")
+        d['flag'] = 'Exception'
+
+    d['state'] = d['state'].upper()
+
+    for k in ['city', 'county']:
+        d[k] = d[k].capitalize()
+
+    return d
+
+
+def resolve_locations(locations):
+    """
+    Resolving each unique location once (using the location cache or the gazetteer) and then mapping it back to
+    every tweet.
+
+    :param locations: a pandas series with free text locations
+    :return: dataframe with city, county, state, country, flag information having the same index as "locations"
+    """
+    gazetteer = get_gazetteer()
+    cache = get_location_cache(gazetteer)
+    codes, unique_locations = pd.factorize(locations)
+
+    RTweet_List = []
+    for location in unique_locations:
+        d = cache.get(location)
+        if d is None:
+            d = resolve_location(location, gazetteer)
+            cache.put(location, d)
+        RTweet_List.append(d)
+
+    cache.report()
+
+    RTweetInfo = pd.DataFrame(RTweet_List, columns=LOCATION_FIELDS).iloc[codes]
+    RTweetInfo.index = locations.index
+    return RTweetInfo
 
 
 def retweetLoc(df, flag='None', col_name='None'):
@@ -141,66 +629,10 @@ def retweetLoc(df, flag='None', col_name='None'):
     :param col_name: it defines the corresponding column based on location type
     :return: dataframe with city, county, state, country information
     """
-    cities, city_dict, state_dict, county_dict, county_transformed_dict = city_state_county()
-    df = df[df['Flag_Loc'] == flag]
-    RTweetLoc = pd.DataFrame(df[col_name].unique(), columns=['Location'])
-    RTweetLoc['Separated'] = RTweetLoc['Location'].str.split(',')
-    RTweetLoc['len'] = RTweetLoc['Separated'].apply(lambda x: len(x))
-
-    d = dict()
-    RTweet_List = []
-    for itr in range(RTweetLoc.shape[0]):
-
-        for k in ['city', 'county', 'state', 'country', 'flag']:
-            d[k] = ''
-        try:
-            for loc in RTweetLoc['Separated'].iloc[itr][::-1]:
-
-                loc = re.sub("[^0-9A-Za-z ]", '', loc.strip().lower())
-                loc = loc.replace('saint', 'st.')
-                if (d['country'] == '') and (
-                        loc in ['usa', 'united states', 'us', 'united states of america', 'america']):
-                    d['country'] = 'US'
-                    d['flag'] = 'Success'
-                elif (d['state'] == '') and (loc in state_dict.keys()):
-                    d['state'] = (((len(loc) > 2) and state_dict[loc]) or loc)
-                    d['country'] = 'US'
-                    d['flag'] = 'Success'
-                elif (d['county'] == '') and (d['state'] != '') and (
-                        (loc in county_dict[d['state']]) or (loc in county_transformed_dict[d['state']])):
-                    d['county'] = loc
-                    d['flag'] = 'Success'
-                elif (d['state'] != '') and (loc in city_dict[d['state']]):
-                    d['city'] = loc
-                    d['country'] = 'US'
-                    d['county'] = \
-                        cities[(cities['city'] == loc) * (cities['state_id'] == d['state'])]['county_name'].iloc[0]
-                    d['flag'] = 'Success'
-                elif ((RTweetLoc['len'].iloc[itr] == 1) or (d['country'] == 'US')) and (loc in list(cities['city'])):
-                    d['city'] = loc
-                    d['country'] = 'US'
-                    d['flag'] = 'Success'
-                    d['state'] = (cities[cities['city'] == loc]['state_id'].iloc[0])
-                    d['county'] = (cities[cities['city'] == loc]['county_name'].iloc[0])
-                elif d['flag'] != 'Success':
-                    d['flag'] = 'Conditions Not Met'
-        except Exception as e:
-            print(e, "\nContinuing.")
-            d['flag'] = 'Exception'
-
-        d['state'] = d['state'].upper()
-
-        for k in ['city', 'county']:
-            d[k] = d[k].capitalize()
-
-        RTweet_List.append(d.copy())
-
-    RTweetLoc.drop(['Separated', 'len'], axis=1, inplace=True)
-    RTweetInfo = pd.concat([RTweetLoc, pd.DataFrame(RTweet_List)], axis=1)
+    df = df[df['Flag_Loc'] == flag].reset_index(drop=True)
     df['lng'] = 'NA'
     df['lat'] = 'NA'
-    df = df.merge(RTweetInfo, how='left', right_on='Location', left_on=col_name)
-    df.drop('Location', axis=1, inplace=True)
+    df = pd.concat([df, resolve_locations(df[col_name])], axis=1)
 
     return df
 
@@ -213,6 +645,7 @@ def geo_tagging(df, region):
     at the time of tweeting.
     lastly, user's location given in his/her profile. This field is less reliable as nobody generally update their
     location and also it's a free string field i.e we can input any textual data without any particular format.
+    Tweets without any location information are kept with "No Location" flag.
 
     :param df: dataframe with tweets information
     :param region: country name
@@ -231,30 +664,33 @@ def geo_tagging(df, region):
     df[['retweet_location', 'bbox_coords', 'location']] = df[['retweet_location', 'bbox_coords', 'location']].astype(
         'str')
 
-    df['Flag_GeoCoord'] = (df['bbox_coords'] != 'NA NA NA NA NA NA NA NA').astype('int')
-    df['Flag_ReTweetLoc'] = (df['retweet_location'] != 'nan').astype('int')
-    df['Flag_UserProfileLoc'] = (df['location'] != 'nan').astype('int')
-
-    df['Flag_Loc'] = df.apply(lambda x:
-                              'GeoCoord' if x['Flag_GeoCoord'] else
-                              ('ReTweetLoc' if x['Flag_ReTweetLoc'] else
-                               ('UserProfileLoc' if x['Flag_UserProfileLoc'] else 'NA')), axis=1)
-
-    df.drop(['Flag_GeoCoord', 'Flag_ReTweetLoc', 'Flag_UserProfileLoc'], axis=1, inplace=True)
-
-    # Calling Functions to extract the city, county, state and Country information
-    final_df = []
+    is_geo_coord = ((df['bbox_coords'] != 'NA NA NA NA NA NA NA NA') & (df['bbox_coords'] != 'nan')).values
+    is_retweet_loc = (df['retweet_location'] != 'nan').values
+    is_user_profile_loc = (df['location'] != 'nan').values
+    df['Flag_Loc'] = np.select([is_geo_coord, is_retweet_loc, is_user_profile_loc],
+                               ['GeoCoord', 'ReTweetLoc', 'UserProfileLoc'], default='NA')
 
-    if sum(df['Flag_Loc'] == 'GeoCoord') > 0:
-        print(' Getting GeoCoding Info')
-        final_df.append(coord(df, flag='GeoCoord', col_name='bbox_coords'))
-    if sum(df['Flag_Loc'] == 'ReTweetLoc') > 0:
-        print(' Processing RetweetLoc')
-        final_df.append(retweetLoc(df, flag='ReTweetLoc', col_name='retweet_location'))
-    if sum(df['Flag_Loc'] == 'UserProfileLoc') > 0:
-        print(' Processing UserProfileLoc')
-        final_df.append(retweetLoc(df, flag='UserProfileLoc', col_name='location'))
-
-    final_df = pd.concat(final_df, axis=0, sort=False)
+    df['lng'] = 'NA'
+    df['lat'] = 'NA'
+    for k in ['city', 'county', 'state', 'country']:
+        df[k] = ''
+    df['flag'] = 'No Location'
+
+    # Calling Functions to extract the city, county, state and Country information. Only the location column of
+    # the matching rows is passed, and the results are written back in place.
+    flag_loc = df['Flag_Loc'].values
+    for flag, col_name, message in [('GeoCoord', 'bbox_coords', ' Getting GeoCoding Info'),
+                                    ('ReTweetLoc', 'retweet_location', ' Processing RetweetLoc'),
+                                    ('UserProfileLoc', 'location', ' Processing UserProfileLoc')]:
+        mask = flag_loc == flag
+        if mask.sum() == 0:
+            continue
+        print(message)
+        if flag == 'GeoCoord':
+            info = geocode(df.loc[mask, col_name])
+            info['flag'] = 'Success'
+        else:
+            info = resolve_locations(df.loc[mask, col_name])
+        df.loc[mask, info.columns] = info.values
 
-    return final_df
+    return df
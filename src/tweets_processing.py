@@ -2,11 +2,19 @@ import warnings
 import os
 import pandas as pd
 import argparse
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
+import pickle
 import re
+import shutil
+import sys
+import tempfile
+import time
 from pytz import timezone
 import datetime
-from Utilities import load_config, store_file, retrieve_file, list_files, exists, get_modified_time
+from multiprocessing import Pool
+from Utilities import load_config, store_file, retrieve_file, list_files, list_file_properties, exists, \
+    get_modified_time, get_checksum, remove_file, rewrite_file
 warnings.simplefilter('ignore')
 os.chdir(os.getcwd())
 
@@ -16,6 +24,21 @@ PROCESSED_PATH = ''
 WEEKLY_DATA_PATH = ''
 FLAT_FILES_PATH = ''
 CURRENT_YEAR = datetime.date.today().year
+# Emotions object of a file worker. It's set once per worker by "init_worker".
+WORKER_EMOTIONS = None
+# Parquet files stored before this run i.e. raw file name (without extension) -> paths of its parts. It's
+# listed once by "get_parquet_parts".
+PARQUET_PARTS = None
+# Number of buffered rows after which the weekly files are written.
+WEEKLY_BUFFER_ROWS = 500000
+# Number of rows read at once while stored files are rewritten i.e. while stored tweets are removed.
+REWRITE_CHUNK_ROWS = 500000
+
+# Text cleaning patterns
+MULTIPLE_SPACES = re.compile(r"\s\s+")
+NEW_LINES_TABS = re.compile(r"(\r+)|(\t+)")
+HASHTAGS = re.compile(r'[#]\w+')
+SPECIAL_CHARACTERS = re.compile(r"(<u\+\S*>)|([#]\w+)|(\w+:\/\/\S+)|([^0-9A-Za-z ])|(\s\s+)")
 
 
 def update_global_variables():
@@ -72,6 +95,22 @@ def week_min_max_date_dict(dates_df, year):
     return calendar_dict
 
 
+def text_normalization(text):
+    """
+    Normalizing a tweet in a single pass.
+
+    :param text: raw tweet
+    :return: a tuple of lower cased text without \\r, \\t characters, ";" separated hashtags and cleaned text
+    """
+    # Removing the \r, \t characters which the texts into new rows while importing into BI tools.
+    text = NEW_LINES_TABS.sub("", MULTIPLE_SPACES.sub(" ", text.lower()))
+    # Creating hashtags
+    hashtags = ';'.join("'{}'".format(hashtag) for hashtag in HASHTAGS.findall(text))
+    # Cleaning Text
+    cleaned_text = SPECIAL_CHARACTERS.sub("", text)
+    return text, hashtags, cleaned_text
+
+
 def data_preprocessing(filepath, filename, req_col, emotions):
     """
     We're doing following tasks in the function:
@@ -90,21 +129,54 @@ def data_preprocessing(filepath, filename, req_col, emotions):
     data = retrieve_file(filepath, filename, usecols=req_col)
     # Removing records with duplicate tweet id
     data = data[~data.status_id.duplicated()].reset_index(drop=True)
+    return tweets_cleaning(data, emotions)
+
+
+def data_preprocessing_chunks(filepath, filename, req_col, emotions, chunksize):
+    """
+    Same as "data_preprocessing" but the raw file is read and processed in chunks of "chunksize" rows, so the
+    memory doesn't depend on the size of the raw file. Tweet ids of the previous chunks are kept to remove
+    duplicate tweets across the chunks.
+
+    :param emotions: emotions class object
+    :param filepath: file path of raw data files.
+    :param filename: file name of each raw file.
+    :param req_col: passing a list of important columns
+    :param chunksize: number of rows in each chunk
+    :return: generator of processed data frames.
+    """
+    status_ids = set()
+    for data in retrieve_file(filepath, filename, usecols=req_col, chunksize=chunksize):
+        # Removing records with duplicate tweet id within the chunk and with previous chunks
+        data = data[~data.status_id.duplicated()]
+        data = data[~data.status_id.isin(status_ids)].reset_index(drop=True)
+        status_ids.update(data.status_id)
+        yield tweets_cleaning(data, emotions)
+
+
+def tweets_cleaning(data, emotions):
+    """
+    Language filter, text cleaning and emotion classification of the raw tweets.
+
+    :param data: raw tweets without duplicate tweet ids
+    :param emotions: emotions class object
+    :return: returning a processed data frame.
+    """
     # Considering only english language tweets
     data = data[data['lang'] == 'en']
     data.reset_index(inplace=True, drop=True)
-    # Removing the \r, \t characters which the texts into new rows while importing into BI tools.
-    data['text'] = data.text.apply(lambda x: re.sub("(\\r+)|(\r+)|(\t+)|(\\t+)", "", re.sub("\s\s+", " ", x.lower())))
-    # Creating hashtags
-    data['hashtags'] = data.text.apply(
-        lambda x: str(re.findall('[#]\w+', x)).replace('[', '').replace(']', '').replace(', ', ';'))
-    # Cleaning Text
-    data['cleaned_text'] = data.text.apply(
-        lambda x: re.sub("(<u\+\S*>)|([#]\w+)|(\w+:\/\/\S+)|([^0-9A-Za-z ])|(\s\s+)", "", x))
-    # Creating date
-    data['date'] = pd.to_datetime(data['created_at'], yearfirst=True).dt.date
-    # Creating week
-    data['week'] = pd.to_datetime(data['date']).dt.week
+    # Text, hashtags and cleaned text in a single pass over the tweets
+    started_at = time.time()
+    normalized = [text_normalization(x) for x in data['text']]
+    data['text'] = [x[0] for x in normalized]
+    data['hashtags'] = [x[1] for x in normalized]
+    data['cleaned_text'] = [x[2] for x in normalized]
+    del normalized
+    print(" Normalized {} tweets: {:.0f} tweets/sec".format(len(data), len(data) / max(time.time() - started_at, 1e-6)))
+    # Creating date and week
+    created_at = pd.to_datetime(data['created_at'], yearfirst=True)
+    data['date'] = created_at.dt.date
+    data['week'] = created_at.dt.week
     # Emotional features
     emotion_info = emotions.get_emotions(data.cleaned_text)
     # Combining emotion_info to dataframe
@@ -113,36 +185,457 @@ def data_preprocessing(filepath, filename, req_col, emotions):
     return data
 
 
-def main(storage, locations, region, incremental=True, nfiles=-1):
+def parquet_types(data):
+    """
+    Assigning explicit types to the processed tweets before storing them in parquet format.
+
+    :param data: processed tweets
+    :return: dataframe with typed columns
+    """
+    data = data.copy()
+    emotion_cols = ['fear', 'trust', 'anger', 'disgust', 'negative',
+                    'positive', 'joy', 'anticipation', 'surprise', 'sadness']
+    data[emotion_cols] = data[emotion_cols].astype('int32')
+    data['week'] = data['week'].astype('int16')
+    data['date'] = pd.to_datetime(data['date']).dt.date
+    data['created_at'] = pd.to_datetime(data['created_at'], yearfirst=True)
+    for col in ['user_id', 'status_id']:
+        data[col] = data[col].astype(str)
+    # Remaining text columns may have a mix of strings and numbers (or NaN). Empty and "nan" strings are stored as
+    # nulls, same as what we get after reading the csv files.
+    for col in data.columns[data.dtypes == object].drop('date'):
+        values = data[col]
+        data[col] = values.astype(str).where(values.notnull() & ~values.isin(['', 'nan']), None)
+    return data
+
+
+def get_parquet_parts():
+    global PARQUET_PARTS
+    if PARQUET_PARTS is None:
+        PARQUET_PARTS = defaultdict(list)
+        for file in list_files(WEEKLY_DATA_PATH, format='parquet', recursive=True):
+            # Parts are named "{source_file}_{part}" i.e. the part number is always 5 digits.
+            part = re.fullmatch(r'(.+)_[0-9]{5}\.parquet', file.split('/')[-1])
+            if part is not None:
+                PARQUET_PARTS[part.group(1)].append(file)
+    return PARQUET_PARTS
+
+
+def store_parquet_partitions(data, source_file, partition_state=False, part=None):
+    """
+    Storing processed tweets as parquet files partitioned by week (and state) i.e.
+    WEEKLY_DATA_PATH/week={week}/state={state}/{source_file}_{part}.parquet. Every raw file has its own files in
+    each partition and all of them are removed before its first part is stored, so processing a file again
+    (chunked or not) never leaves stale parts behind.
+
+    :param data: processed tweets
+    :param source_file: name of the raw file
+    :param partition_state: partition by state as well
+    :param part: chunk number when a raw file is processed in chunks
+    """
+    data = parquet_types(data)
+    partition_cols = ['week']
+    if partition_state:
+        data['state_partition'] = data['state'].fillna('').replace('', 'NA')
+        partition_cols.append('state_partition')
+
+    stem = source_file.rsplit('.', 1)[0]
+    part = part or 0
+    if part == 0:
+        for file in get_parquet_parts().pop(stem, []):
+            remove_file(f"{WEEKLY_DATA_PATH}/{file}")
+
+    filename = '{}_{:05d}.parquet'.format(stem, part)
+    for keys, partition in data.groupby(partition_cols):
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        folder = 'week={}'.format(keys[0])
+        if partition_state:
+            folder += '/state={}'.format(keys[1])
+            partition = partition.drop('state_partition', axis=1)
+        store_file(partition, WEEKLY_DATA_PATH, '{}/{}'.format(folder, filename))
+
+
+class FileManifest:
+    """
+    Processed raw files of a location stored as an append-only log (files_{loc}.csv) with the name, size,
+    version (modified time or etag) and content hash (md5) of each file. A record is appended as soon as a file
+    is stored, so an interrupted run resumes at the first file which wasn't recorded. Size and version are only
+    a pre-check: files whose size and version haven't changed are skipped without reading them, otherwise the
+    md5 of the content decides whether a file has changed (a new etag or modified time alone isn't a change).
+    """
+    COLUMNS = ['file', 'size', 'version', 'checksum', 'processed_at']
+
+    def __init__(self, loc, reset=False):
+        self.filepath = f"{PATH}/{loc}"
+        self.filename = "files_{}.csv".format(loc)
+        self.records = {}
+        self.create_new_file = reset or not exists(f"{PROCESSED_PATH}/{self.filename}")
+        if not reset:
+            self.load(loc)
+
+    def load(self, loc):
+        if exists(f"{PROCESSED_PATH}/{self.filename}"):
+            # Everything is read as stored, e.g. an empty checksum stays empty and versions aren't parsed as numbers.
+            log = retrieve_file(PROCESSED_PATH, self.filename, sep='\t', dtype=str, na_filter=False)
+            # Later records win.
+            self.records = {record['file']: record for record in log.to_dict('records')}
+            if len(log) > 2 * len(self.records):
+                self.compact()
+        elif exists(f"{PROCESSED_PATH}/files_{loc}.pkl"):
+            # One time import of the old pickled list of file names, assuming these files haven't changed since.
+            print(' Importing files_{}.pkl'.format(loc))
+            properties = list_file_properties(self.filepath)
+            for file in retrieve_file(PROCESSED_PATH, "files_{}.pkl".format(loc)):
+                if file in properties:
+                    self.records[file] = self.record(file, properties[file], checksum='')
+            self.compact()
+
+    def record(self, file, properties, checksum=None):
+        if checksum is None:
+            checksum = get_checksum(f"{self.filepath}/{file}")
+        return {'file': file, 'size': str(properties['size']), 'version': properties['version'],
+                'checksum': checksum, 'processed_at': str(datetime.datetime.now(timezone(os.getenv('TIMEZONE'))))}
+
+    def pending(self, properties):
+        """
+        :param properties: dictionary of file name -> size and version of the raw files
+        :return: list of new or changed files, in the same order as "properties"
+        """
+        filenames = []
+        for file, props in properties.items():
+            record = self.records.get(file)
+            if record is None:
+                filenames.append(file)
+            elif (record['size'], record['version']) != (str(props['size']), props['version']):
+                checksum = get_checksum(f"{self.filepath}/{file}")
+                if checksum == record['checksum']:
+                    # Only touched i.e. recording new version so the file isn't hashed again.
+                    self.commit(self.record(file, props, checksum))
+                else:
+                    print(' {} has changed'.format(file))
+                    filenames.append(file)
+        return filenames
+
+    def commit(self, record):
+        self.records[record['file']] = record
+        store_file(pd.DataFrame([record], columns=self.COLUMNS), PROCESSED_PATH, self.filename, sep='\t',
+                   mode='w' if self.create_new_file else 'a', header=self.create_new_file)
+        self.create_new_file = False
+
+    def compact(self):
+        log = pd.DataFrame(list(self.records.values()), columns=self.COLUMNS)
+        store_file(log, PROCESSED_PATH, self.filename, sep='\t')
+        self.create_new_file = False
+
+
+class WeeklyPartitionWriter:
+    """
+    Buffering processed tweets per week across all the files of a run and writing each weekly file in one bulk
+    write when the buffer has "max_rows" rows or at the end of the run. Manifest records of the buffered files
+    are committed only after their data is written, so an interrupted run never skips unwritten data.
+    """
+    def __init__(self, incremental, Prog_Started_at, max_rows=WEEKLY_BUFFER_ROWS):
+        self.incremental = incremental
+        self.Prog_Started_at = Prog_Started_at
+        self.max_rows = max_rows
+        if exists(f'{PROCESSED_PATH}/week_min_max_dict_{CURRENT_YEAR}.pkl'):
+            self.calendar = retrieve_file(PROCESSED_PATH, 'week_min_max_dict_{}.pkl'.format(CURRENT_YEAR))
+        else:
+            dates = calendar_generation(CURRENT_YEAR)
+            self.calendar = week_min_max_date_dict(dates, CURRENT_YEAR)
+        self.buffers = defaultdict(list)
+        self.rows = 0
+        self.records = []
+        # Whether a weekly file has to be (re)created; resolved once per week and run.
+        self.create_new_file = {}
+
+    def write(self, data):
+        # Dividing data into weeks.
+        for w, weekly_df in data.groupby('week', sort=False):
+            self.buffers[w].append(weekly_df)
+            self.rows += len(weekly_df)
+        if self.rows >= self.max_rows:
+            self.flush()
+
+    def add_record(self, manifest, record):
+        self.records.append((manifest, record))
+
+    def flush(self):
+        for w, frames in self.buffers.items():
+            filename = 'Week{}_{}_{}.csv'.format(w, self.calendar[w]['min_date'], self.calendar[w]['max_date'])
+            if filename not in self.create_new_file:
+                weekly_file = '{}/{}'.format(WEEKLY_DATA_PATH, filename)
+                self.create_new_file[filename] = (not exists(weekly_file)) or \
+                                                 (
+                                                         (not self.incremental)
+                                                         and
+                                                         self.Prog_Started_at > get_modified_time(weekly_file)
+                                                 )
+            create_new_file = self.create_new_file[filename]
+            store_file(pd.concat(frames), WEEKLY_DATA_PATH, filename, '\t', mode='w' if create_new_file else 'a',
+                       header=create_new_file)
+            self.create_new_file[filename] = False
+        self.buffers = defaultdict(list)
+        self.rows = 0
+
+        for manifest, record in self.records:
+            manifest.commit(record)
+        self.records = []
+
+    def remove(self, status_ids, weeks):
+        """
+        :param status_ids: set of status ids (strings) to be removed from the stored weekly files
+        :param weeks: weeks whose files may contain these status ids
+        """
+        for w in weeks:
+            if w in self.calendar:
+                filename = 'Week{}_{}_{}.csv'.format(w, self.calendar[w]['min_date'], self.calendar[w]['max_date'])
+                remove_stored_tweets(WEEKLY_DATA_PATH, filename, status_ids)
+
+
+class StoredTweets:
+    """
+    Status ids and weeks of the tweets stored by each raw file of a location (stored_tweets_{loc}.csv). Ids of
+    every processed chunk are appended before the chunk itself is stored, so the tweets of a changed file and the
+    tweets which an interrupted run stored for a file that wasn't recorded yet can always be removed before the
+    file is stored again.
+    """
+    COLUMNS = ['file', 'status_id', 'week']
+
+    def __init__(self, loc, reset=False):
+        self.filename = "stored_tweets_{}.csv".format(loc)
+        self.create_new_file = reset or not exists(f"{PROCESSED_PATH}/{self.filename}")
+
+    def add(self, file, data):
+        ids = pd.DataFrame({'file': file, 'status_id': data['status_id'], 'week': data['week']},
+                           columns=self.COLUMNS)
+        store_file(ids, PROCESSED_PATH, self.filename, sep='\t', mode='w' if self.create_new_file else 'a',
+                   header=self.create_new_file)
+        self.create_new_file = False
+
+    def chunks(self):
+        if self.create_new_file:
+            return []
+        return retrieve_file(PROCESSED_PATH, self.filename, sep='\t', chunksize=REWRITE_CHUNK_ROWS, dtype=str,
+                             na_filter=False)
+
+    def previous(self, files):
+        """
+        :param files: raw file names
+        :return: set of status ids (strings) and set of weeks of the tweets stored by "files"
+        """
+        status_ids = set()
+        weeks = set()
+        for chunk in self.chunks():
+            chunk = chunk[chunk['file'].isin(files)]
+            status_ids.update(chunk['status_id'])
+            weeks.update(pd.to_numeric(chunk['week'], errors='coerce').dropna().astype(int))
+        return status_ids, weeks
+
+    def drop(self, files):
+        rewrite_file((chunk[~chunk['file'].isin(files)] for chunk in self.chunks()), PROCESSED_PATH,
+                     self.filename, sep='\t')
+
+
+def remove_stored_tweets(filepath, filename, status_ids):
+    """
+    Removing tweets from a stored file. The file is read and rewritten in chunks i.e. it's never loaded at once.
+
+    :param status_ids: set of status ids (strings) to be removed from the stored file
+    """
+    if not exists(f'{filepath}/{filename}'):
+        return
+    removed = 0
+    for chunk in retrieve_file(filepath, filename, sep='\t', usecols=['status_id'], chunksize=REWRITE_CHUNK_ROWS,
+                               dtype=str, na_filter=False):
+        removed += chunk['status_id'].isin(status_ids).sum()
+    if removed > 0:
+        print(' Removing {} tweet(s) from {}'.format(removed, filename))
+        # Stored values are kept as they are i.e. nothing is parsed.
+        chunks = retrieve_file(filepath, filename, sep='\t', chunksize=REWRITE_CHUNK_ROWS, dtype=str,
+                               na_filter=False)
+        rewrite_file((chunk[~chunk['status_id'].isin(status_ids)] for chunk in chunks), filepath, filename,
+                     sep='\t')
+
+
+def remove_previous_tweets(stored_tweets, files, storage, weekly_writer=None):
+    """
+    Removing the tweets stored earlier by the raw files which are going to be (re)processed, i.e. by an earlier
+    version of a changed file or by an interrupted run, so their tweets aren't duplicated. Parquet files are
+    replaced per raw file while storing, see "store_parquet_partitions".
+
+    :param stored_tweets: StoredTweets object of the location
+    :param files: raw file names
+    :param storage: storage type
+    :param weekly_writer: WeeklyPartitionWriter object used by "weekly" storage
+    """
+    status_ids, weeks = stored_tweets.previous(files)
+    if len(status_ids) == 0:
+        return
+    if 'single' in storage:
+        remove_stored_tweets(PROCESSED_PATH, 'Processed_Tweets.csv', status_ids)
+    if 'weekly' in storage:
+        weekly_writer.remove(status_ids, weeks)
+    # Records are dropped only after the tweets are removed, so an interrupted removal is done again.
+    stored_tweets.drop(files)
+
+
+def process_file(filepath, file, req_col, emotions, chunksize=-1):
+    """
+    :param chunksize: if positive, the file is processed in chunks of "chunksize" rows.
+    :return: iterable of processed data frames of the raw file.
+    """
+    if chunksize > 0:
+        return data_preprocessing_chunks(filepath, file, req_col, emotions, chunksize)
+    return [data_preprocessing(filepath, file, req_col, emotions)]
+
+
+def init_worker():
+    # Every worker loads its own emotions object once; emotion classification isn't parallelised any further.
+    global WORKER_EMOTIONS
+    WORKER_EMOTIONS = Emotions()
+
+
+def process_file_worker(args):
+    """
+    Processing a raw file in a worker. Processed chunks are spilled (pickled) into "spill_dir" one by one instead
+    of being returned, so neither the worker nor the main process holds more than one chunk of the file.
+
+    :param args: tuple of (filepath, file, req_col, chunksize, spill_dir)
+    :return: list of spilled files in the same order as the chunks
+    """
+    filepath, file, req_col, chunksize, spill_dir = args
+    spilled = []
+    try:
+        for data in process_file(filepath, file, req_col, WORKER_EMOTIONS, chunksize):
+            fd, spill_file = tempfile.mkstemp(suffix='.pkl', dir=spill_dir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            spilled.append(spill_file)
+    except SystemExit:
+        # A worker exiting never returns its result, i.e. the main process would wait forever.
+        raise RuntimeError('Processing failed for file: {}'.format(file))
+    return spilled
+
+
+def load_spilled(spilled):
+    for spill_file in spilled:
+        with open(spill_file, 'rb') as f:
+            data = pickle.load(f)
+        os.remove(spill_file)
+        yield data
+
+
+def parallel_results(pool, args, window):
+    """
+    Processing raw files in the pool with at most "window" files submitted at a time.
+
+    :param pool: multiprocessing pool
+    :param args: list of "process_file_worker" arguments
+    :param window: maximum number of submitted (processing or processed but not yet stored) files
+    :return: generator of processed chunks of each file, in the same order as "args". Errors of the workers are
+    raised here.
+    """
+    args = iter(args)
+    submitted = deque(pool.apply_async(process_file_worker, (x,)) for x in islice(args, window))
+    while len(submitted) > 0:
+        spilled = submitted.popleft().get()
+        for x in islice(args, 1):
+            submitted.append(pool.apply_async(process_file_worker, (x,)))
+        yield load_spilled(spilled)
+
+
+def store_processed_data(data, file, storage, region, incremental, Prog_Started_at, partition_state=False,
+                         part=None, weekly_writer=None, stored_tweets=None):
+    """
+    Geotagging a processed data frame and appending it into the output files.
+
+    :param data: processed data frame of raw file "file"
+    :param file: raw file name
+    :param part: chunk number when a raw file is processed in chunks
+    :param weekly_writer: WeeklyPartitionWriter object used by "weekly" storage
+    :param stored_tweets: StoredTweets object of the location used by "single" and "weekly" storage
+    """
+    data = data[~data.status_id.duplicated()].reset_index(drop=True)
+    if stored_tweets is not None:
+        # Ids are recorded before the tweets are stored, so an interrupted file never leaves unrecorded tweets.
+        stored_tweets.add(file, data)
+
+    # Geotagging
+    data = geo_tagging(data, region)
+
+    # Changing the order of "Text" column and keeping it as the last column
+    text_info = data['text']
+    data.drop('text', axis=1, inplace=True)
+    data['text'] = text_info
+    del text_info
+
+    if 'single' in storage:
+        create_new_file = (not exists(f'{PROCESSED_PATH}/Processed_Tweets.csv')) \
+                          or \
+                          (
+                                (not incremental)
+                                and
+                                Prog_Started_at > get_modified_time(f'{PROCESSED_PATH}/Processed_Tweets.csv')
+                          )
+        store_file(data, PROCESSED_PATH, 'Processed_Tweets.csv', sep='\t', mode='a', header=create_new_file)
+
+    if 'weekly' in storage:
+        weekly_writer.write(data)
+
+    if 'parquet' in storage:
+        store_parquet_partitions(data, file, partition_state, part)
+
+
+def main(storage, locations, region, incremental=True, nfiles=-1, emotion_workers=1, partition_state=False,
+         chunksize=-1, workers=1, buffer_rows=-1):
     """
     Data cleaning, emotion classification and extracting geo information from multiple columns by
     assigning value into "city", "state", "county" and "country".
 
     :param nfiles: Number of files to be processed; Just for debugging and testing purpose.
     :param storage: this defines whether you want to store processed data in a "Single" file
-    or break into "Weekly" files i.e. 4 files every month.
+    or break into "Weekly" files i.e. 4 files every month or "Parquet" files partitioned by week.
     :param locations: list of locations for which you fetched the data using Twitter API. Make sure location details
     exactly matches with your search queries
     :param region: country name
     :param incremental: Bool value defines whether to process the data for new files or for all files.
+    :param emotion_workers: number of processes used for emotion classification. It can't be combined with
+    "workers" > 1 since every worker classifies the emotions of its own files.
+    :param partition_state: partition parquet files by state as well as week.
+    :param chunksize: if positive, raw files are processed and stored in chunks of "chunksize" rows.
+    :param workers: number of processes used to clean and classify raw files (of all locations) in parallel.
+    Geotagging, storing and updating "files_{loc}.csv" is done by the main process only, in the same order
+    as the files are listed, so the output doesn't depend on the number of workers.
+    :param buffer_rows: number of buffered rows after which the weekly files are written. If not positive, it's
+    "chunksize" when raw files are processed in chunks and WEEKLY_BUFFER_ROWS otherwise.
     :return: return processed data with emotions and geo information
     """
     req_col = ['user_id', 'screen_name', 'status_id', 'created_at',
                'text', 'source', 'is_retweet', 'retweet_count', 'hashtags', 'status_url',
                'urls_t.co', 'lang', 'retweet_created_at', 'verified', 'retweet_location', 'location', 'bbox_coords']
+    global PARQUET_PARTS
+    if workers > 1 and emotion_workers > 1:
+        print('Error: "emotion_workers" ({}) can\'t be used with "workers" ({}). Kindly use only one of them.'
+              .format(emotion_workers, workers))
+        sys.exit(1)
+
     Prog_Started_at = datetime.datetime.now(timezone(os.getenv('TIMEZONE')))
+    # Parquet files are listed again in every run.
+    PARQUET_PARTS = None
+    manifests = {}
+    stored_tweets = {}
+    tasks = []
     for loc in locations:
-        files_processed = []
         filepath = f"{PATH}/{loc}"
-        filenames = list_files(filepath)
-        # Incremental loading
-        if incremental and exists(f"{PROCESSED_PATH}/files_{loc}.pkl"):
-            # Checking if any new file exist. If so, process only that file instead of processing all files again.
-            files_processed = retrieve_file(PROCESSED_PATH, "files_{}.pkl".format(loc))
-            filenames = list(set(filenames) - set(files_processed))
-            if len(filenames) == 0:
-                print('No new file is present.')
-                return
+        properties = list_file_properties(filepath)
+        # Incremental loading i.e. processing only new or changed files. Otherwise, all files are processed again
+        # and a new manifest is started.
+        manifests[loc] = FileManifest(loc, reset=not incremental)
+        filenames = manifests[loc].pending(properties)
+        if len(filenames) == 0:
+            print('No new file is present for location: {}'.format(loc))
+            continue
 
         # Removing files contain "last_tweet" and "first_tweet" in filename
         temp = []
@@ -155,66 +648,72 @@ def main(storage, locations, region, incremental=True, nfiles=-1):
         if nfiles > 0:
             filenames = filenames[:min(len(filenames), nfiles)]
 
-        # Creating Emotions object
-        emotions = Emotions()
-
+        if 'single' in storage or 'weekly' in storage:
+            stored_tweets[loc] = StoredTweets(loc, reset=not incremental)
         print("--Processing following file(s) for location: {}".format(loc))
-        for file in filenames:
+        tasks += [(loc, filepath, file, properties[file]) for file in filenames]
+
+    if len(tasks) == 0:
+        return
+
+    pool = None
+    emotions = None
+    spill_dir = None
+    if workers > 1:
+        pool = Pool(min(workers, len(tasks)), initializer=init_worker)
+        spill_dir = tempfile.mkdtemp(prefix='processed_tweets_')
+        # Results are returned in the same order as the tasks i.e. files are stored deterministically.
+        results = parallel_results(pool, [(filepath, file, req_col, chunksize, spill_dir)
+                                          for _, filepath, file, _ in tasks], 2 * workers)
+    else:
+        # Creating Emotions object
+        emotions = Emotions(workers=emotion_workers)
+        results = (process_file(filepath, file, req_col, emotions, chunksize) for _, filepath, file, _ in tasks)
+
+    try:
+        if buffer_rows <= 0:
+            buffer_rows = chunksize if chunksize > 0 else WEEKLY_BUFFER_ROWS
+        weekly_writer = WeeklyPartitionWriter(incremental, Prog_Started_at, buffer_rows) \
+            if 'weekly' in storage else None
+        # Tweets stored earlier by the files to be processed (changed or interrupted files) are removed first.
+        for loc in stored_tweets:
+            remove_previous_tweets(stored_tweets[loc], [task[2] for task in tasks if task[0] == loc], storage,
+                                   weekly_writer)
+        for (loc, filepath, file, file_properties), chunks in zip(tasks, results):
             print(file)
-            data = data_preprocessing(filepath, file, req_col, emotions)
-
-            data = data[~data.status_id.duplicated()].reset_index(drop=True)
-
-            # Geotagging
-            data = geo_tagging(data, region)
-
-            # Changing the order of "Text" column and keeping it as the last column
-            text_info = data['text']
-            data.drop('text', axis=1, inplace=True)
-            data['text'] = text_info
-            del text_info
-
-            if 'single' in storage:
-                create_new_file = (not exists(f'{PROCESSED_PATH}/Processed_Tweets.csv')) \
-                                  or \
-                                  (
-                                        (not incremental)
-                                        and
-                                        Prog_Started_at > get_modified_time(f'{PROCESSED_PATH}/Processed_Tweets.csv')
-                                  )
-                store_file(data, PROCESSED_PATH, 'Processed_Tweets.csv', sep='\t', mode='a', header=create_new_file)
-
-            if 'weekly' in storage:
-                if exists(f'{PROCESSED_PATH}/week_min_max_dict_{CURRENT_YEAR}.pkl'):
-                    calendar = retrieve_file(PROCESSED_PATH, 'week_min_max_dict_{}.pkl'.format(CURRENT_YEAR))
-                else:
-                    dates = calendar_generation(CURRENT_YEAR)
-                    calendar = week_min_max_date_dict(dates, CURRENT_YEAR)
-
-                # Dividing data into weeks.
-                for w in data['week'].unique():
-                    weekly_df = data[data['week'] == w]
-
-                    filename = 'Week{}_{}_{}.csv'.format(w, calendar[w]['min_date'], calendar[w]['max_date'])
-                    file = '{}/{}'.format(WEEKLY_DATA_PATH, filename)
-
-                    create_new_file = (not exists(file)) or \
-                                      (
-                                              (not incremental)
-                                              and
-                                              Prog_Started_at > get_modified_time(file)
-                                      )
-                    store_file(weekly_df, WEEKLY_DATA_PATH, filename, '\t', mode='a', header=create_new_file)
-
-            files_processed.append(file)
-            store_file(files_processed, PROCESSED_PATH, "files_{}.pkl".format(loc))
+            for part, data in enumerate(chunks):
+                store_processed_data(data, file, storage, region, incremental, Prog_Started_at, partition_state,
+                                     part if chunksize > 0 else None, weekly_writer, stored_tweets.get(loc))
+
+            # File is recorded only after all of its data is stored.
+            record = manifests[loc].record(file, file_properties)
+            if weekly_writer is None:
+                manifests[loc].commit(record)
+            else:
+                weekly_writer.add_record(manifests[loc], record)
             print(' Stored')
 
+        if weekly_writer is not None:
+            weekly_writer.flush()
+        # Location cache is stored once per run instead of after every file.
+        save_location_cache()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            # No-op after a successful "close"; otherwise pending files are dropped.
+            pool.terminate()
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        if emotions is not None:
+            emotions.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--storage', type=str.lower, help='Storage type',
-                        choices=["single", "weekly"], required=True)
+                        choices=["single", "weekly", "parquet"], required=True)
     parser.add_argument('-i', '--incremental', type=eval, help='Incremental Status',
                         choices=[True, False], default=True)
     parser.add_argument('-c', '--config', type=str.lower, help='Configuration Path',
@@ -226,6 +725,18 @@ if __name__ == '__main__':
                         default="usa")
     parser.add_argument('-n', '--files', type=int, help='Number of files to be processed',
                         default=-1)
+    parser.add_argument('-e', '--emotion_workers', type=int, help='Number of processes for emotion classification '
+                                                                  '(only with -w 1)',
+                        default=1)
+    parser.add_argument('-k', '--chunksize', type=int, help='Number of rows of raw files to be processed at once',
+                        default=-1)
+    parser.add_argument('-w', '--workers', type=int, help='Number of processes to process raw files in parallel',
+                        default=1)
+    parser.add_argument('-p', '--partition_state', type=eval, help='Partition parquet files by state',
+                        choices=[True, False], default=False)
+    parser.add_argument('-b', '--buffer_rows', type=int, help='Number of buffered rows after which the weekly '
+                                                              'files are written (default: chunksize)',
+                        default=-1)
 
     args = parser.parse_args()
     # Creating folder names where data is stored.
@@ -235,14 +746,15 @@ if __name__ == '__main__':
     import re
 
     for m in args.locations.split(';'):
-        locations_list.append(re.sub("[^0-9_a-zA-Z]+", "", re.sub('\s+', '_', m.strip())))
+        locations_list.append(re.sub("[^0-9_a-zA-Z]+", "", re.sub(r'\s+', '_', m.strip())))
 
     load_config(args.config)
     update_global_variables()
 
     # Loading Libraries (this has to be load after "load_config" function)
     from emotions_info import Emotions
-    from locations_info import geo_tagging
+    from locations_info import geo_tagging, save_location_cache
 
-    main(args.storage, locations_list, args.region, args.incremental, args.files)
+    main(args.storage, locations_list, args.region, args.incremental, args.files, args.emotion_workers,
+         args.partition_state, args.chunksize, args.workers, args.buffer_rows)
     print("--Processing Done")
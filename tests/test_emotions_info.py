@@ -0,0 +1,36 @@
+import os
+import sys
+import pandas as pd
+from nltk.tokenize import TweetTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from emotions_info import split_tokens  # noqa: E402
+
+TWEETS = [
+    "stay home stay safe covid19",
+    "user8 thanks for the update",
+    "ab8 do8 d8 po8 a8 8dogs 12ab covid19update",
+    "call 555 1234567 or abc5551234567 now",
+    "caf   quotes  ",
+    "café joy",
+    "",
+    "   ",
+    "happy9 fear 2020 angryyy",
+]
+
+
+def words(tokens):
+    # Numbers (including phone numbers) aren't words of the lexicon.
+    return [token for token in tokens if not token.replace(' ', '').isdigit()]
+
+
+def test_split_tokens_matches_tweet_tokenizer():
+    tt = TweetTokenizer()
+    tokens = split_tokens(pd.Series(TWEETS, index=range(10, 10 + len(TWEETS))), tt)
+    for i, tweet in enumerate(TWEETS):
+        assert words(tokens[tokens.index == i].tolist()) == words(tt.tokenize(tweet))
+
+
+def test_split_tokens_splits_letters_followed_by_digits():
+    tokens = split_tokens(["user8 covid19 hello"], TweetTokenizer())
+    assert tokens.tolist() == ['user', 'covid', 'hello']
@@ -0,0 +1,69 @@
+import os
+import re
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import Utilities  # noqa: E402
+import tweets_processing  # noqa: E402
+from tweets_processing import text_normalization  # noqa: E402
+
+TWEETS = [
+    "Stay  HOME, stay safe!! #COVID19 #StayHome",
+    "Line one\r\nline two\tand\ttabs   here",
+    "Vaccine news: https://t.co/abc123 <U+0001F637> #Vaccine",
+    "no hashtags at all",
+    "   ",
+    "",
+    "#a#b ## #_x #9 mixed #Hash-tag's",
+    "Literal \\r and \\t escapes\\r\\r kept?",
+    "Unicode café ñ — “quotes” 😷 #Café",
+]
+
+# Output of the original (baseline) text cleaning, kept verbatim.
+EXPECTED = [
+    ("stay home, stay safe!! #covid19 #stayhome", "'#covid19';'#stayhome'", "stay home stay safe  "),
+    ("line one line twoandtabs here", "", "line one line twoandtabs here"),
+    ("vaccine news: https://t.co/abc123 <u+0001f637> #vaccine", "'#vaccine'", "vaccine news   "),
+    ("no hashtags at all", "", "no hashtags at all"),
+    (" ", "", " "),
+    ("", "", ""),
+    ("#a#b ## #_x #9 mixed #hash-tag's", "'#a';'#b';'#_x';'#9';'#hash'", "    mixed tags"),
+    ("literal \\r and \\t escapes\\r\\r kept?", "", "literal r and t escapesrr kept"),
+    ("unicode café ñ — “quotes” 😷 #café", "'#café'", "unicode caf   quotes  "),
+]
+
+
+def baseline_cleaning(text):
+    """Text cleaning of the original code, column by column."""
+    text = text.apply(lambda x: re.sub("(\\r+)|(\r+)|(\t+)|(\\t+)", "", re.sub(r"\s\s+", " ", x.lower())))
+    hashtags = text.apply(lambda x: str(re.findall(r'[#]\w+', x)).replace('[', '').replace(']', '').replace(', ', ';'))
+    cleaned_text = text.apply(lambda x: re.sub(r"(<u\+\S*>)|([#]\w+)|(\w+:\/\/\S+)|([^0-9A-Za-z ])|(\s\s+)", "", x))
+    return text, hashtags, cleaned_text
+
+
+def test_text_normalization_golden_output():
+    assert [text_normalization(tweet) for tweet in TWEETS] == EXPECTED
+
+
+def test_text_normalization_matches_baseline():
+    tweets = pd.Series(TWEETS * 3, index=range(100, 100 + 3 * len(TWEETS)))
+    assert [text_normalization(tweet) for tweet in tweets] == list(zip(*baseline_cleaning(tweets)))
+
+
+def test_remove_previous_tweets_of_an_older_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(Utilities, 'DATABASE', 'local')
+    monkeypatch.setattr(tweets_processing, 'PROCESSED_PATH', str(tmp_path))
+    monkeypatch.setattr(tweets_processing, 'REWRITE_CHUNK_ROWS', 7)
+    stored = tweets_processing.StoredTweets('loc')
+    for i, (file, ids) in enumerate([('a.csv', range(0, 30)), ('b.csv', range(30, 40)), ('a.csv', range(40, 50))]):
+        data = pd.DataFrame({'status_id': ids, 'week': 18, 'text': 'x'})
+        stored.add(file, data)
+        tweets_processing.store_file(data, str(tmp_path), 'Processed_Tweets.csv', sep='\t', mode='a',
+                                     header=i == 0)
+
+    # A shorter version of "a.csv" only has some of the stored tweets; all of them are removed.
+    tweets_processing.remove_previous_tweets(tweets_processing.StoredTweets('loc'), ['a.csv'], 'single')
+    processed = pd.read_csv(tmp_path / 'Processed_Tweets.csv', sep='\t')
+    assert processed['status_id'].tolist() == list(range(30, 40))
+    assert tweets_processing.StoredTweets('loc').previous(['a.csv', 'b.csv'])[0] == set(map(str, range(30, 40)))